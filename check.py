@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import hashlib
+import io
 import json
+import math
+import multiprocessing
 import os
+import queue
 import random
+import runpy
 import secrets
+import signal
 import string
 import subprocess
+import threading
+import sys
+import tempfile
 import traceback
-from collections import defaultdict
+from collections import Counter, defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from threading import Lock, current_thread
-from typing import List, Tuple
+from threading import Lock, Timer, current_thread, local
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import time
 import yaml
@@ -26,8 +37,13 @@ CHECKERS_PATH = BASE_DIR / 'checkers'
 MAX_THREADS = int(os.getenv('MAX_THREADS', default=2 * os.cpu_count()))
 RUNS = int(os.getenv('RUNS', default=10))
 HOST = os.getenv('HOST', default='127.0.0.1')
-OUT_LOCK = Lock()
-DISABLE_LOG = False
+DAEMON = os.getenv('DAEMON', default='0') == '1'
+# Warn when p99 latency of an action is closer than this fraction to the checker timeout
+TIMEOUT_MARGIN = float(os.getenv('TIMEOUT_MARGIN', default=0.25))
+STATS_FILE = os.getenv('STATS_FILE')
+EVENTS_FILE = os.getenv('EVENTS_FILE')
+STRESS_MAX = int(os.getenv('STRESS_MAX', default=64))
+STRESS_ROUNDS = int(os.getenv('STRESS_ROUNDS', default=2))
 
 DC_REQUIRED_OPTIONS = ['version', 'services']
 DC_ALLOWED_OPTIONS = DC_REQUIRED_OPTIONS + ['volumes']
@@ -52,6 +68,7 @@ PROXIES = ['nginx', 'envoy']
 CLEANERS = ['dedcleaner']
 
 VALIDATE_DIRS = ['checkers', 'services', 'internal', 'sploits']
+VALIDATE_CACHE_PATH = BASE_DIR / '.validate_cache.json'
 # For local testing
 IGNORE_DIR_PATTERNS = ["node_modules"]
 
@@ -69,6 +86,16 @@ FORBIDDEN_CHECKER_PATTERNS = [
 ]
 
 
+VERDICTS = {
+    101: 'OK',
+    102: 'CORRUPT',
+    103: 'MUMBLE',
+    104: 'DOWN',
+    110: 'CHECK_FAILED',
+    124: 'TIMEOUT',
+}
+
+
 class ColorType(Enum):
     INFO = '\033[92m'
     WARNING = '\033[93m'
@@ -85,50 +112,371 @@ def generate_flag(name):
     return name[0].upper() + ''.join(random.choices(alph, k=30)) + '='
 
 
-def colored_log(*messages, color: ColorType = ColorType.INFO):
-    ts = datetime.utcnow().isoformat(sep=' ', timespec='milliseconds')
-    print(
-        f'{color}{color.name} [{current_thread().name} {ts}]{ColorType.ENDC}', *messages)
+def format_log(*messages, color: ColorType = ColorType.INFO, ts: Optional[datetime] = None) -> str:
+    ts = (ts or datetime.utcnow()).isoformat(sep=' ', timespec='milliseconds')
+    header = f'{color}{color.name} [{current_thread().name} {ts}]{ColorType.ENDC}'
+    return ' '.join(map(str, (header,) + messages)) + '\n'
+
+
+class EventSink:
+    # All console and events file writes happen in a single writer thread,
+    # producers only put records into a queue
+    def __init__(self, path: Optional[str]):
+        # Opened here, so a bad path fails on the caller's thread
+        self._events_file = open(path, 'a') if path is not None else None
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Events', daemon=True)
+                self._thread.start()
+
+    def emit(self, record: Optional[Dict], text: Optional[str] = None, output: Optional['Output'] = None):
+        self._ensure_started()
+        self._queue.put(('emit', record, text, output))
+
+    def flush(self, output: 'Output'):
+        self._call('flush', output)
+
+    def sync(self):
+        self._call('sync', None)
+
+    def _call(self, kind: str, output: Optional['Output']):
+        self._ensure_started()
+        thread = self._thread
+        done = threading.Event()
+        self._queue.put((kind, done, None, output))
+        while not done.wait(0.5):
+            if thread is None or not thread.is_alive():
+                return
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._events_file is not None:
+            self._events_file.close()
+            self._events_file = None
+
+    def _handle(self, kind: str, payload, text: Optional[str], output: Optional['Output']):
+        events_file = self._events_file
+        if kind == 'emit':
+            if payload is not None and events_file is not None:
+                events_file.write(json.dumps(payload) + '\n')
+            if text is not None:
+                output.render(text)
+        elif kind == 'flush':
+            output.render_buffer()
+        else:
+            sys.stdout.flush()
+            if events_file is not None:
+                events_file.flush()
+
+    def _run(self):
+        failed = False
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                kind, payload, text, output = item
+                try:
+                    self._handle(kind, payload, text, output)
+                except Exception:
+                    # A failed write must not kill the writer, callers wait on it
+                    if not failed:
+                        traceback.print_exc()
+                    failed = True
+                finally:
+                    if kind != 'emit':
+                        payload.set()
+        finally:
+            try:
+                sys.stdout.flush()
+            except Exception:
+                pass
+            if self._events_file is not None:
+                self._events_file.flush()
+
+
+EVENTS = EventSink(EVENTS_FILE)
+
+
+class Output:
+    def __init__(self, buffered: bool = False, service: Optional[str] = None):
+        self._buffer = io.StringIO() if buffered else None
+        self._buffered = buffered
+        self._service = service
+        self.disabled = False
+
+    def log(self, *messages, color: ColorType = ColorType.INFO):
+        if self.disabled:
+            return
+        now = datetime.utcnow()
+        record = {
+            'type': 'log',
+            'ts': time.time(),
+            'thread': current_thread().name,
+            'service': self._service,
+            'level': color.name,
+            'message': ' '.join(map(str, messages)),
+        }
+        EVENTS.emit(record, format_log(*messages, color=color, ts=now), self)
+
+    def event(self, record: Dict):
+        EVENTS.emit({'ts': time.time(), 'service': self._service, **record})
+
+    def write(self, data: str):
+        EVENTS.emit(None, data, self)
+
+    @property
+    def buffered(self) -> bool:
+        return self._buffered
+
+    def flush(self):
+        # Print everything collected so far at once, log directly afterwards
+        self._buffered = False
+        EVENTS.flush(self)
+
+    def render(self, text: str):
+        if self._buffer is not None:
+            self._buffer.write(text)
+        else:
+            sys.stdout.write(text)
+
+    def render_buffer(self):
+        if self._buffer is not None:
+            sys.stdout.write(self._buffer.getvalue())
+            sys.stdout.flush()
+            self._buffer = None
+
+
+CONSOLE = Output()
+
+
+def run_forked_action(exe_path: str, args: List[str], timeout: int,
+                      env: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, bytes]:
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # own process group, so a timeout also kills whatever the checker started
+                os.setpgid(0, 0)
+                os.dup2(out.fileno(), 1)
+                os.dup2(err.fileno(), 2)
+                if env is not None:
+                    # same semantics as subprocess.run(env=...)
+                    os.environ.clear()
+                    os.environ.update(env)
+                sys.argv = [exe_path] + args
+                runpy.run_path(exe_path, run_name='__main__')
+                code = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    code = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        try:
+            # also set from the parent, the timer may fire before the child runs
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = Timer(timeout, kill)
+        timer.start()
+        _, status = os.waitpid(pid, 0)
+        timer.cancel()
+
+        # same return code as coreutils timeout
+        returncode = 124 if timed_out else os.waitstatus_to_exitcode(status)
+
+        out.seek(0)
+        err.seek(0)
+        return returncode, out.read(), err.read()
+
+
+def checker_daemon_worker(exe_path: str, conn):
+    sys.path.insert(0, os.path.dirname(exe_path))
+    try:
+        # Warm up imports, actions are run from forked children
+        runpy.run_path(exe_path, run_name='__checker__')
+    except BaseException:
+        pass
+
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        args, timeout, env = request
+        conn.send(run_forked_action(exe_path, args, timeout, env))
+
+
+class CheckerDaemon:
+    def __init__(self, exe_path: Path):
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(
+            target=checker_daemon_worker,
+            args=(str(exe_path), child_conn),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+
+    def run(self, args: List[str], timeout: int, env: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, bytes]:
+        self._conn.send((args, timeout, env))
+        return self._conn.recv()
+
+    def is_alive(self) -> bool:
+        return self._process.is_alive()
+
+    def close(self):
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join()
+
+
+class CheckerDaemonPool:
+    def __init__(self, exe_path: Path):
+        self._exe_path = exe_path
+        self._idle = queue.Queue()
+        self._daemons = []
+        self._lock = Lock()
+
+    def _get(self) -> CheckerDaemon:
+        while True:
+            try:
+                daemon = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if daemon.is_alive():
+                return daemon
+            self._discard(daemon)
+
+        daemon = CheckerDaemon(self._exe_path)
+        with self._lock:
+            self._daemons.append(daemon)
+        return daemon
+
+    def _discard(self, daemon: CheckerDaemon):
+        with self._lock:
+            if daemon in self._daemons:
+                self._daemons.remove(daemon)
+        daemon.close()
+
+    def run(self, args: List[str], timeout: int, env: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, bytes]:
+        daemon = self._get()
+        try:
+            return daemon.run(args, timeout, env)
+        finally:
+            # a dead daemon is replaced by a new one on the next run
+            if daemon.is_alive():
+                self._idle.put(daemon)
+            else:
+                self._discard(daemon)
+
+    def close(self):
+        with self._lock:
+            daemons, self._daemons = self._daemons, []
+        for daemon in daemons:
+            daemon.close()
+        self._idle = queue.Queue()
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class LatencyStats:
+    def __init__(self):
+        self._lock = Lock()
+        self._samples = defaultdict(list)
+
+    def add(self, key: str, elapsed: float):
+        with self._lock:
+            self._samples[key].append(elapsed)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            samples = {key: list(values) for key, values in self._samples.items()}
+
+        return {
+            key: {
+                'count': len(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': max(values),
+            }
+            for key, values in sorted(samples.items())
+        }
 
 
 class BaseValidator:
+    _output: Output = CONSOLE
+
     def _log(self, message: str):
-        with OUT_LOCK:
-            if not DISABLE_LOG:
-                colored_log(f'{self}: {message}')
+        self._output.log(f'{self}: {message}')
 
     def _fatal(self, cond, message):
-        global DISABLE_LOG
-
-        with OUT_LOCK:
-            if not cond:
-                if not DISABLE_LOG:
-                    colored_log(f'{self}: {message}', color=ColorType.FAIL)
-                DISABLE_LOG = True
-                raise AssertionError
+        if not cond:
+            self._output.log(f'{self}: {message}', color=ColorType.FAIL)
+            self._output.disabled = True
+            raise AssertionError
 
     def _warning(self, cond: bool, message: str) -> bool:
-        with OUT_LOCK:
-            if not cond and not DISABLE_LOG:
-                colored_log(f'{self}: {message}', color=ColorType.WARNING)
+        if not cond:
+            self._output.log(f'{self}: {message}', color=ColorType.WARNING)
         return not cond
 
     def _error(self, cond, message) -> bool:
-        with OUT_LOCK:
-            if not cond and not DISABLE_LOG:
-                colored_log(f'{self}: {message}', color=ColorType.FAIL)
+        if not cond:
+            self._output.log(f'{self}: {message}', color=ColorType.FAIL)
         return not cond
 
 
 class Checker(BaseValidator):
-    def __init__(self, name: str):
+    def __init__(self, name: str, output: Output = CONSOLE):
         self._name = name
+        self._output = output
         self._exe_path = CHECKERS_PATH / self._name / 'checker.py'
         self._fatal(
             os.access(self._exe_path, os.X_OK),
             f'{self._exe_path.relative_to(BASE_DIR)} must be executable',
         )
         self._timeout = 3
+        self._stats = LatencyStats()
+        self._daemons: Optional[CheckerDaemonPool] = None
+        if DAEMON:
+            self._daemons = CheckerDaemonPool(self._exe_path)
         self._get_info()
 
     def _get_info(self):
@@ -155,16 +503,46 @@ class Checker(BaseValidator):
             'attack_data': self._attack_data,
         }
 
-    def _run_command(self, command: List[str], env=None) -> Tuple[str, str]:
-        action = command[1].upper()
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def _execute(self, command: List[str], env=None, vuln: Optional[int] = None) -> Tuple[int, str, str, float]:
         cmd = ['timeout', str(self._timeout)] + command
 
         start = time.monotonic()
-        p = subprocess.run(cmd, capture_output=True, check=False, env=env)
+        if self._daemons is not None:
+            returncode, stdout, stderr = self._daemons.run(
+                command[1:], self._timeout, env)
+        else:
+            p = subprocess.run(cmd, capture_output=True, check=False, env=env)
+            returncode, stdout, stderr = p.returncode, p.stdout, p.stderr
         elapsed = time.monotonic() - start
 
-        out = p.stdout.decode()
-        err = p.stderr.decode()
+        action = command[1].upper()
+        self._output.event({
+            'type': 'action',
+            'thread': current_thread().name,
+            'action': action,
+            'vuln': vuln,
+            'returncode': returncode,
+            'verdict': VERDICTS.get(returncode),
+            'elapsed': elapsed,
+            'stdout_size': len(stdout),
+            'stderr_size': len(stderr),
+            'flag_id': command[3] if action in ('PUT', 'GET') else None,
+        })
+
+        return returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace'), elapsed
+
+    def _run_command(self, command: List[str], env=None, vuln: Optional[int] = None) -> Tuple[str, str]:
+        action = command[1].upper()
+        returncode, out, err, elapsed = self._execute(command, env=env, vuln=vuln)
+        self._stats.add(action if vuln is None else f'{action} vuln {vuln}', elapsed)
 
         out_s = out.rstrip('\n')
         err_s = err.rstrip('\n')
@@ -172,11 +550,11 @@ class Checker(BaseValidator):
         self._log(
             f'action: {action}\ntime: {elapsed:.2f}s\nstdout:\n{out_s}\nstderr:\n{err_s}')
         self._fatal(
-            p.returncode != 124,
+            returncode != 124,
             f'action {action}: bad return code: 124, probably {ColorType.BOLD}timeout{ColorType.ENDC}',
         )
-        self._fatal(p.returncode == 101,
-                    f'action {action}: bad return code: {p.returncode}')
+        self._fatal(returncode == 101,
+                    f'action {action}: bad return code: {returncode}')
         return out, err
 
     def check(self):
@@ -187,7 +565,7 @@ class Checker(BaseValidator):
     def put(self, flag: str, flag_id: str, vuln: int):
         self._log(f'running PUT, flag={flag} flag_id={flag_id} vuln={vuln}')
         cmd = [str(self._exe_path), 'put', HOST, flag_id, flag, str(vuln)]
-        out, err = self._run_command(cmd)
+        out, err = self._run_command(cmd, vuln=vuln)
 
         self._fatal(out, 'stdout is empty')
 
@@ -202,7 +580,7 @@ class Checker(BaseValidator):
     def get(self, flag: str, flag_id: str, vuln: int):
         self._log(f'running GET, flag={flag} flag_id={flag_id} vuln={vuln}')
         cmd = [str(self._exe_path), 'get', HOST, flag_id, flag, str(vuln)]
-        self._run_command(cmd)
+        self._run_command(cmd, vuln=vuln)
 
     def run_all(self, step: int):
         self._log(f'running all actions (run {step} of {RUNS})')
@@ -215,13 +593,39 @@ class Checker(BaseValidator):
             flag_id = flag_id.strip()
             self.get(flag, flag_id, vuln)
 
+    def run_round(self) -> List[Tuple[str, int, float]]:
+        # Same actions as run_all, but failures are returned instead of being fatal
+        results = []
+
+        returncode, _, _, elapsed = self._execute([str(self._exe_path), 'check', HOST])
+        results.append(('CHECK', returncode, elapsed))
+
+        for vuln in range(1, self._vulns + 1):
+            flag = generate_flag(self._name)
+            cmd = [str(self._exe_path), 'put', HOST, secrets.token_hex(16), flag, str(vuln)]
+            returncode, _, flag_id, elapsed = self._execute(cmd, vuln=vuln)
+            results.append((f'PUT vuln {vuln}', returncode, elapsed))
+            if returncode != 101:
+                continue
+
+            cmd = [str(self._exe_path), 'get', HOST, flag_id.strip(), flag, str(vuln)]
+            returncode, _, _, elapsed = self._execute(cmd, vuln=vuln)
+            results.append((f'GET vuln {vuln}', returncode, elapsed))
+
+        return results
+
+    def close(self):
+        if self._daemons is not None:
+            self._daemons.close()
+
     def __str__(self):
         return f'checker {self._name}'
 
 
 class Service(BaseValidator):
-    def __init__(self, name: str):
+    def __init__(self, name: str, output: Output = CONSOLE):
         self._name = name
+        self._output = output
         self._path = SERVICES_PATH / self._name
         self._dc_path = self._path / 'docker-compose.yml'
         self._fatal(
@@ -229,19 +633,32 @@ class Service(BaseValidator):
             f'{self._dc_path.relative_to(BASE_DIR)} missing',
         )
 
-        self._checker = Checker(self._name)
+        self._checker = Checker(self._name, output)
+        self._elapsed = 0
+        self._stress_report = []
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def output(self):
+        return self._output
+
     @property
     def checker_info(self):
         return self._checker.info
 
     def _run_dc(self, *args):
         cmd = ['docker-compose', '-f', str(self._dc_path)] + list(args)
-        subprocess.run(cmd, check=True)
+        if not self._output.buffered:
+            EVENTS.sync()
+            subprocess.run(cmd, check=True)
+            return
+
+        p = subprocess.run(cmd, check=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._output.write(p.stdout.decode(errors='replace'))
+        p.check_returncode()
 
     def up(self):
         self._log('starting')
@@ -260,34 +677,206 @@ class Service(BaseValidator):
 
         cnt_threads = max(1, min(MAX_THREADS, RUNS // 10))
         self._log(f'starting {cnt_threads} checker threads')
-        with ThreadPoolExecutor(
-                max_workers=cnt_threads,
-                thread_name_prefix='Executor',
-        ) as executor:
-            for _ in executor.map(self._checker.run_all, range(1, RUNS + 1)):
-                pass
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=cnt_threads,
+                    thread_name_prefix='Executor',
+            ) as executor:
+                for _ in executor.map(self._checker.run_all, range(1, RUNS + 1)):
+                    pass
+        finally:
+            self._elapsed = time.monotonic() - start
+            self._checker.close()
+
+        self.log_latency_report()
+
+    def stress(self):
+        self._log(f'stress testing checker up to {STRESS_MAX} concurrent runs')
+
+        self._stress_report = []
+        concurrency = 1
+        try:
+            while concurrency <= STRESS_MAX:
+                with ThreadPoolExecutor(
+                        max_workers=concurrency,
+                        thread_name_prefix='Stress',
+                ) as executor:
+                    start = time.monotonic()
+                    rounds = list(executor.map(
+                        lambda _: self._checker.run_round(),
+                        range(concurrency * STRESS_ROUNDS),
+                    ))
+                    elapsed = time.monotonic() - start
+
+                results = [result for r in rounds for result in r]
+                verdicts = Counter(VERDICTS.get(returncode, f'CODE {returncode}') for _, returncode, _ in results)
+                latencies = [latency for _, _, latency in results]
+                step = {
+                    'concurrency': concurrency,
+                    'actions': len(results),
+                    'success_rate': verdicts['OK'] / len(results),
+                    'verdicts': dict(verdicts),
+                    'elapsed': elapsed,
+                    'p50': percentile(latencies, 50),
+                    'p99': percentile(latencies, 99),
+                    'max': max(latencies),
+                }
+                self._stress_report.append(step)
+
+                self._log(
+                    f'concurrency {concurrency}: {step["success_rate"]:.1%} OK of {len(results)} actions '
+                    f'in {elapsed:.2f}s, verdicts: {dict(verdicts)}, '
+                    f'p50={step["p50"]:.2f}s p99={step["p99"]:.2f}s max={step["max"]:.2f}s')
+
+                if self._warning(
+                        verdicts['OK'] == len(results),
+                        f'checker starts failing at concurrency {concurrency}'):
+                    break
+
+                concurrency *= 2
+            else:
+                self._log(f'no failures up to concurrency {STRESS_MAX}')
+        finally:
+            self._checker.close()
+
+    @property
+    def stress_report(self):
+        return self._stress_report
+
+    def latency_report(self):
+        actions = self._checker.stats.report()
+        elapsed = self._elapsed
+        total = sum(stats['count'] for key, stats in actions.items() if key != 'INFO')
+        return {
+            'timeout': self._checker.timeout,
+            'runs': RUNS,
+            'elapsed': elapsed,
+            'actions_per_second': total / elapsed if elapsed else 0,
+            'runs_per_second': RUNS / elapsed if elapsed else 0,
+            'actions': actions,
+        }
+
+    def log_latency_report(self):
+        report = self.latency_report()
+        lines = [
+            f'{key:<16} count={stats["count"]:<5} p50={stats["p50"]:.2f}s p90={stats["p90"]:.2f}s '
+            f'p99={stats["p99"]:.2f}s max={stats["max"]:.2f}s'
+            for key, stats in report['actions'].items()
+        ]
+        self._log(
+            f'latency report ({report["runs"]} runs in {report["elapsed"]:.2f}s, '
+            f'{report["runs_per_second"]:.2f} runs/s, {report["actions_per_second"]:.2f} actions/s):\n'
+            + '\n'.join(lines))
+
+        limit = report['timeout'] * (1 - TIMEOUT_MARGIN)
+        for key, stats in report['actions'].items():
+            self._warning(
+                stats['p99'] < limit,
+                f'action {key}: p99 latency {stats["p99"]:.2f}s is within {TIMEOUT_MARGIN:.0%} '
+                f'of checker timeout {report["timeout"]}s',
+            )
 
     def __str__(self):
         return f'service {self._name}'
 
 
+def file_fingerprint(f: Path) -> Optional[Dict]:
+    try:
+        stat = f.stat()
+        digest = hashlib.sha256(f.read_bytes()).hexdigest()
+    except OSError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+
+
+def file_matches(f: Path, fingerprint: Optional[Dict]) -> bool:
+    if fingerprint is None:
+        return not f.exists()
+    try:
+        stat = f.stat()
+    except OSError:
+        return False
+    if stat.st_size == fingerprint['size'] and stat.st_mtime_ns == fingerprint['mtime_ns']:
+        return True
+    current = file_fingerprint(f)
+    return current is not None and current['digest'] == fingerprint['digest']
+
+
+class ValidationCache:
+    def __init__(self, path: Path, load: bool = True):
+        self._path = path
+        self._lock = Lock()
+        self._entries = {}
+        # Any change of the validation rules invalidates the whole cache
+        self._salt = file_fingerprint(Path(__file__).resolve())['digest']
+
+        if not load:
+            return
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('salt') == self._salt:
+            self._entries = data.get('entries', {})
+
+    def get(self, f: Path) -> Optional[List[str]]:
+        with self._lock:
+            entry = self._entries.get(os.path.relpath(f, BASE_DIR))
+        if entry is None or not file_matches(f, entry['file']):
+            return None
+        for dependency, fingerprint in entry['dependencies'].items():
+            if not file_matches(BASE_DIR / dependency, fingerprint):
+                return None
+        return entry['findings']
+
+    def put(self, f: Path, dependencies: List[Path], findings: List[str]):
+        entry = {
+            'file': file_fingerprint(f),
+            'dependencies': {
+                os.path.relpath(dependency, BASE_DIR): file_fingerprint(dependency)
+                for dependency in dependencies
+            },
+            'findings': findings,
+        }
+        with self._lock:
+            self._entries[os.path.relpath(f, BASE_DIR)] = entry
+
+    def save(self):
+        with self._lock:
+            data = {'salt': self._salt, 'entries': self._entries}
+        self._path.write_text(json.dumps(data))
+
+
 class StructureValidator(BaseValidator):
-    def __init__(self, d: Path, service: Service):
+    def __init__(self, d: Path, service: Service, cache: Optional[ValidationCache] = None):
         self._dir = d
         self._was_error = False
         self._service = service
+        self._output = service.output
+        self._cache = cache
+        self._local = local()
 
     def _error(self, cond, message):
-        err = super()._error(cond, message)
-        self._was_error |= err
-        return err
+        if not cond:
+            self._local.findings.append(message)
+        return not cond
 
     def validate(self):
+        files = []
         for d in VALIDATE_DIRS:
-            self.validate_dir(self._dir / d / self._service.name)
+            files.extend(self.collect_files(self._dir / d / self._service.name))
+
+        with ThreadPoolExecutor(
+                max_workers=MAX_THREADS,
+                thread_name_prefix='Validator',
+        ) as executor:
+            for findings in executor.map(self.check_file, files):
+                for message in findings:
+                    self._was_error |= super()._error(False, message)
         return not self._was_error
 
-    def validate_dir(self, d: Path):
+    def collect_files(self, d: Path) -> Iterator[Path]:
         if not d.exists():
             return
         for ignore_pattern in IGNORE_DIR_PATTERNS:
@@ -295,9 +884,14 @@ class StructureValidator(BaseValidator):
                 return
         for f in d.iterdir():
             if f.is_file():
-                self.validate_file(f)
+                yield f
             elif f.name[0] != '.':
-                self.validate_dir(f)
+                yield from self.collect_files(f)
+
+    def check_file(self, f: Path) -> List[str]:
+        self._local.findings = []
+        self.validate_file(f)
+        return self._local.findings
 
     def validate_file(self, f: Path):
         path = f.relative_to(BASE_DIR)
@@ -306,166 +900,228 @@ class StructureValidator(BaseValidator):
                     f'{path} found, should be named .keep')
 
         if f.name == 'docker-compose.yml':
-            with f.open() as file:
-                dc = yaml.safe_load(file)
+            validate_content = self.validate_compose
+        elif BASE_DIR / "checkers" in f.parents and f.suffix == ".py":
+            validate_content = self.validate_checker_code
+        else:
+            return
 
-            if self._error(isinstance(dc, dict), f'{path} is not dict'):
-                return
+        cached = self._cache.get(f) if self._cache is not None else None
+        if cached is not None:
+            self._local.findings.extend(cached)
+            return
 
-            for opt in DC_REQUIRED_OPTIONS:
-                if self._error(opt in dc, f'required option {opt} not in {path}'):
-                    return
+        start = len(self._local.findings)
+        self._local.dependencies = []
+        validate_content(f, path)
+        if self._cache is not None:
+            self._cache.put(f, self._local.dependencies, self._local.findings[start:])
 
-            if self._error(isinstance(dc['version'], str), f'version option in {path} is not string'):
-                return
+    def validate_compose(self, f: Path, path: Path):
+        with f.open() as file:
+            dc = yaml.safe_load(file)
 
-            try:
-                dc_version = float(dc['version'])
-            except ValueError:
-                self._error(False, f'version option in {path} is not float')
+        if self._error(isinstance(dc, dict), f'{path} is not dict'):
+            return
+
+        for opt in DC_REQUIRED_OPTIONS:
+            if self._error(opt in dc, f'required option {opt} not in {path}'):
                 return
 
+        if self._error(isinstance(dc['version'], str), f'version option in {path} is not string'):
+            return
+
+        try:
+            dc_version = float(dc['version'])
+        except ValueError:
+            self._error(False, f'version option in {path} is not float')
+            return
+
+        self._error(
+            2.4 <= dc_version < 3,
+            f'invalid version in {path}, need >=2.4 and <3, got {dc_version}',
+        )
+
+        for opt in dc:
             self._error(
-                2.4 <= dc_version < 3,
-                f'invalid version in {path}, need >=2.4 and <3, got {dc_version}',
+                opt in DC_ALLOWED_OPTIONS,
+                f'option {opt} in {path} is not allowed',
             )
 
-            for opt in dc:
+        services = []
+        databases = []
+        proxies = []
+        dependencies = defaultdict(list)
+
+        if self._error(isinstance(dc['services'], dict), f'services option in {path} is not dict'):
+            return
+
+        for container, container_conf in dc['services'].items():
+            if self._error(isinstance(container_conf, dict),
+                           f'config in {path} for container {container} is not dict'):
+                continue
+
+            for opt in CONTAINER_REQUIRED_OPTIONS:
                 self._error(
-                    opt in DC_ALLOWED_OPTIONS,
-                    f'option {opt} in {path} is not allowed',
+                    opt in container_conf,
+                    f'required option {opt} not in {path} for container {container}',
                 )
 
-            services = []
-            databases = []
-            proxies = []
-            dependencies = defaultdict(list)
+            self._error('restart' in container_conf and container_conf['restart'] == 'unless-stopped',
+                        f'restart option in {path} for container {container} must be equal to "unless-stopped"')
 
-            if self._error(isinstance(dc['services'], dict), f'services option in {path} is not dict'):
-                return
+            for opt in container_conf:
+                self._error(
+                    opt in CONTAINER_ALLOWED_OPTIONS,
+                    f'option {opt} in {path} is not allowed for container {container}',
+                )
+
+            if self._error(
+                    'image' not in container_conf or 'build' not in container_conf,
+                    f'both image and build options in {path} for container {container}'):
+                continue
+
+            if self._error(
+                    'image' in container_conf or 'build' in container_conf,
+                    f'both image and build options not in {path} for container {container}'):
+                continue
+
+            if 'image' in container_conf:
+                image = container_conf['image']
+            else:
+                build = container_conf['build']
+                if isinstance(build, str):
+                    dockerfile = f.parent / build / 'Dockerfile'
+                else:
+                    context = build['context']
+                    if 'dockerfile' in build:
+                        dockerfile = f.parent / \
+                            context / build['dockerfile']
+                    else:
+                        dockerfile = f.parent / context / 'Dockerfile'
+
+                self._local.dependencies.append(dockerfile)
+                if self._error(dockerfile.exists(), f'no dockerfile found in {dockerfile}'):
+                    continue
+
+                with dockerfile.open() as file:
+                    dfp = DockerfileParser(fileobj=file)
+                    image = dfp.baseimage
 
-            for container, container_conf in dc['services'].items():
-                if self._error(isinstance(container_conf, dict),
-                               f'config in {path} for container {container} is not dict'):
+                if self._error(image is not None, f'no image option in {dockerfile}'):
                     continue
 
-                for opt in CONTAINER_REQUIRED_OPTIONS:
+            if 'depends_on' in container_conf:
+                for dependency in container_conf['depends_on']:
+                    dependencies[container].append(dependency)
+
+            is_service = True
+            for database in DATABASES:
+                if database in image:
+                    databases.append(container)
+                    is_service = False
+
+            for proxy in PROXIES:
+                if proxy in image:
+                    proxies.append(container)
+                    is_service = False
+
+            for cleaner in CLEANERS:
+                if cleaner in image:
+                    is_service = False
+
+            if is_service:
+                services.append(container)
+                for opt in SERVICE_REQUIRED_OPTIONS:
                     self._error(
                         opt in container_conf,
-                        f'required option {opt} not in {path} for container {container}',
+                        f'required option {opt} not in {path} for service {container}',
                     )
 
-                self._error('restart' in container_conf and container_conf['restart'] == 'unless-stopped',
-                            f'restart option in {path} for container {container} must be equal to "unless-stopped"')
-
                 for opt in container_conf:
                     self._error(
-                        opt in CONTAINER_ALLOWED_OPTIONS,
-                        f'option {opt} in {path} is not allowed for container {container}',
+                        opt in SERVICE_ALLOWED_OPTIONS,
+                        f'option {opt} in {path} is not allowed for service {container}',
                     )
 
-                if self._error(
-                        'image' not in container_conf or 'build' not in container_conf,
-                        f'both image and build options in {path} for container {container}'):
-                    continue
-
-                if self._error(
-                        'image' in container_conf or 'build' in container_conf,
-                        f'both image and build options not in {path} for container {container}'):
-                    continue
-
-                if 'image' in container_conf:
-                    image = container_conf['image']
-                else:
-                    build = container_conf['build']
-                    if isinstance(build, str):
-                        dockerfile = f.parent / build / 'Dockerfile'
-                    else:
-                        context = build['context']
-                        if 'dockerfile' in build:
-                            dockerfile = f.parent / \
-                                context / build['dockerfile']
-                        else:
-                            dockerfile = f.parent / context / 'Dockerfile'
-
-                    if self._error(dockerfile.exists(), f'no dockerfile found in {dockerfile}'):
-                        continue
-
-                    with dockerfile.open() as file:
-                        dfp = DockerfileParser(fileobj=file)
-                        image = dfp.baseimage
-
-                    if self._error(image is not None, f'no image option in {dockerfile}'):
-                        continue
-
-                if 'depends_on' in container_conf:
-                    for dependency in container_conf['depends_on']:
-                        dependencies[container].append(dependency)
-
-                is_service = True
-                for database in DATABASES:
-                    if database in image:
-                        databases.append(container)
-                        is_service = False
-
-                for proxy in PROXIES:
-                    if proxy in image:
-                        proxies.append(container)
-                        is_service = False
-
-                for cleaner in CLEANERS:
-                    if cleaner in image:
-                        is_service = False
-
-                if is_service:
-                    services.append(container)
-                    for opt in SERVICE_REQUIRED_OPTIONS:
-                        self._error(
-                            opt in container_conf,
-                            f'required option {opt} not in {path} for service {container}',
-                        )
-
-                    for opt in container_conf:
-                        self._error(
-                            opt in SERVICE_ALLOWED_OPTIONS,
-                            f'option {opt} in {path} is not allowed for service {container}',
-                        )
+        for service in services:
+            for database in databases:
+                self._error(
+                    service in dependencies and database in dependencies[service],
+                    f'service {service} may need to depends_on database {database}')
 
+        for proxy in proxies:
             for service in services:
-                for database in databases:
-                    self._error(
-                        service in dependencies and database in dependencies[service],
-                        f'service {service} may need to depends_on database {database}')
-
-            for proxy in proxies:
-                for service in services:
-                    self._error(
-                        proxy in dependencies and service in dependencies[proxy],
-                        f'proxy {proxy} may need to depends_on service {service}')
+                self._error(
+                    proxy in dependencies and service in dependencies[proxy],
+                    f'proxy {proxy} may need to depends_on service {service}')
 
-        elif BASE_DIR / "checkers" in f.parents and f.suffix == ".py":
-            checker_code = f.read_text()
-            for p in ALLOWED_CHECKER_PATTERNS:
-                checker_code = checker_code.replace(p, "")
-            for p in FORBIDDEN_CHECKER_PATTERNS:
-                self._error(p not in checker_code,
-                            f'forbidden pattern "{p}" in {path}')
+    def validate_checker_code(self, f: Path, path: Path):
+        checker_code = f.read_text()
+        for p in ALLOWED_CHECKER_PATTERNS:
+            checker_code = checker_code.replace(p, "")
+        for p in FORBIDDEN_CHECKER_PATTERNS:
+            self._error(p not in checker_code,
+                        f'forbidden pattern "{p}" in {path}')
 
     def __str__(self):
         return f'Structure validator for {self._service.name}'
 
 
-def get_services() -> List[Service]:
+def get_service_names() -> List[str]:
     if os.getenv('SERVICE') in ['all', None]:
-        result = list(
-            Service(service_path.name) for service_path in SERVICES_PATH.iterdir()
+        return sorted(
+            service_path.name for service_path in SERVICES_PATH.iterdir()
             if service_path.name[0] != '.' and service_path.is_dir()
         )
-    else:
-        result = [Service(os.environ['SERVICE'])]
+    return [os.environ['SERVICE']]
+
+
+def run_services(func: Optional[Callable[[Service], None]] = None) -> List[Service]:
+    names = get_service_names()
+    parallel = len(names) > 1
+
+    def run(name: str) -> Optional[Service]:
+        # Output of concurrently running services is printed in one piece
+        output = Output(buffered=parallel, service=name)
+        try:
+            service = Service(name, output)
+            if func is not None:
+                func(service)
+            return service
+        except AssertionError:
+            if not parallel:
+                raise
+        except Exception as e:
+            if not parallel:
+                raise
+            output.log(f'service {name}: got exception: {e}\n{traceback.format_exc()}', color=ColorType.FAIL)
+        finally:
+            output.flush()
+        return None
+
+    with ThreadPoolExecutor(
+            max_workers=max(1, min(MAX_THREADS, len(names))),
+            thread_name_prefix='Service',
+    ) as executor:
+        results = list(executor.map(run, names))
+
+    if parallel:
+        for name, service in zip(names, results):
+            CONSOLE.log(
+                f'service {name}: {"OK" if service is not None else "FAILED"}',
+                color=ColorType.INFO if service is not None else ColorType.FAIL,
+            )
+
+    if any(service is None for service in results):
+        raise AssertionError
+
+    return results
+
 
-    with OUT_LOCK:
-        colored_log('Got services:', ', '.join(map(str, result)))
+def get_services() -> List[Service]:
+    result = run_services()
+    CONSOLE.log('Got services:', ', '.join(map(str, result)))
     return result
 
 
@@ -474,36 +1130,66 @@ def list_services(_args):
 
 
 def start_services(_args):
-    for service in get_services():
-        service.up()
+    run_services(Service.up)
 
 
 def stop_services(_args):
-    for service in get_services():
-        service.down()
+    run_services(Service.down)
 
 
 def logs_services(_args):
-    for service in get_services():
-        service.logs()
+    run_services(Service.logs)
 
 
 def validate_checkers(_args):
-    for service in get_services():
-        service.validate_checker()
+    reports = {}
 
+    def validate(service: Service):
+        try:
+            service.validate_checker()
+        finally:
+            reports[service.name] = service.latency_report()
 
-def validate_structure(_args):
-    was_error = False
-    for service in get_services():
-        validator = StructureValidator(BASE_DIR, service)
-        if not validator.validate():
-            was_error = True
+    try:
+        run_services(validate)
+    finally:
+        if STATS_FILE is not None:
+            with open(STATS_FILE, 'w') as f:
+                json.dump(reports, f, indent=2)
 
-    if was_error:
-        with OUT_LOCK:
-            colored_log('Structure validator: failed', color=ColorType.FAIL)
-            raise AssertionError
+
+def stress_checkers(_args):
+    reports = {}
+
+    def stress(service: Service):
+        try:
+            service.stress()
+        finally:
+            reports[service.name] = service.stress_report
+
+    try:
+        run_services(stress)
+    finally:
+        if STATS_FILE is not None:
+            with open(STATS_FILE, 'w') as f:
+                json.dump(reports, f, indent=2)
+
+
+def validate_service_structure(service: Service, cache: ValidationCache):
+    validator = StructureValidator(BASE_DIR, service, cache)
+    if not validator.validate():
+        raise AssertionError
+
+
+def validate_structure(args):
+    cache = ValidationCache(VALIDATE_CACHE_PATH, load=not args.force)
+    try:
+        run_services(functools.partial(validate_service_structure, cache=cache))
+    except AssertionError:
+        CONSOLE.log('Structure validator: failed', color=ColorType.FAIL)
+        raise
+    finally:
+        cache.save()
 
 
 def dump_tasks(_args):
@@ -524,13 +1210,15 @@ def dump_tasks(_args):
             'gets': 1,
         })
 
-    colored_log('\n' + yaml.safe_dump(result))
+    CONSOLE.log('\n' + yaml.safe_dump(result))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Validate checkers for A&D. '
-                    'Host & number of runs are passed with HOST and RUNS env vars'
+                    'Host & number of runs are passed with HOST and RUNS env vars, '
+                    'set DAEMON=1 to keep checkers loaded between actions, '
+                    'STATS_FILE to save the latency report as JSON'
     )
     subparsers = parser.add_subparsers()
 
@@ -564,10 +1252,22 @@ if __name__ == '__main__':
     )
     check_parser.set_defaults(func=validate_checkers)
 
+    stress_parser = subparsers.add_parser(
+        'stress',
+        help='Double concurrent checker runs until they fail, '
+             'limits are passed with STRESS_MAX and STRESS_ROUNDS env vars',
+    )
+    stress_parser.set_defaults(func=stress_checkers)
+
     validate_parser = subparsers.add_parser(
         'validate',
         help='Run structure validation',
     )
+    validate_parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Revalidate all files, ignoring the cache of unchanged files',
+    )
     validate_parser.set_defaults(func=validate_structure)
 
     dump_parser = subparsers.add_parser(
@@ -583,7 +1283,10 @@ if __name__ == '__main__':
         exit(1)
 
     try:
-        parsed.func(parsed)
+        try:
+            parsed.func(parsed)
+        finally:
+            EVENTS.close()
     except AssertionError:
         exit(1)
     except Exception as e:
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import mmap
+import random
+import string
+import struct
+import argparse
+import itertools
+
+import pow_solver
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+JSON_PATH = os.path.join(BASE_DIR, 'mine_results.json')
+TABLE_PATH = os.path.join(BASE_DIR, 'mine_results.bin')
+
+# Must match CaptchaHelper in the service.
+ALPHA = string.ascii_uppercase + string.digits
+LENGTH = 3
+HARDNESS = 5
+
+ENTRY = struct.Struct('<I')
+MISSING = 0xffffffff
+SIZE = len(ALPHA) ** LENGTH
+
+
+def challenge_index(challenge):
+    if len(challenge) != LENGTH:
+        return None
+    index = 0
+    for c in challenge:
+        pos = ALPHA.find(c)
+        if pos < 0:
+            return None
+        index = index * len(ALPHA) + pos
+    return index
+
+
+def all_challenges():
+    return (''.join(x) for x in itertools.product(ALPHA, repeat=LENGTH))
+
+
+class AnswerTable:
+    def __init__(self, path=TABLE_PATH):
+        self.path = path
+        self.mm = None
+
+    def open(self):
+        if self.mm is None:
+            with open(self.path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self.mm) != SIZE * ENTRY.size:
+                raise ValueError(f'{self.path}: invalid table size {len(self.mm)}')
+        return self.mm
+
+    def get(self, challenge):
+        index = challenge_index(challenge)
+        if index is None:
+            return None
+        try:
+            mm = self.open()
+        except OSError:
+            return None
+        answer, = ENTRY.unpack_from(mm, index * ENTRY.size)
+        if answer == MISSING:
+            return None
+        return answer
+
+
+def build(json_path, table_path):
+    answers = {}
+    if os.path.exists(json_path):
+        with open(json_path, 'r') as f:
+            answers = json.load(f)
+
+    table = bytearray(SIZE * ENTRY.size)
+    for i, challenge in enumerate(all_challenges()):
+        answer = answers.get(challenge)
+        if answer is None or not pow_solver.check(challenge, answer, HARDNESS):
+            print(f'mining {challenge}', file=sys.stderr)
+            answer = pow_solver.solve(challenge, HARDNESS)
+        ENTRY.pack_into(table, i * ENTRY.size, answer)
+
+    tmp_path = table_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(table)
+    os.replace(tmp_path, table_path)
+
+
+def verify(table_path, sample):
+    table = AnswerTable(table_path)
+    challenges = list(all_challenges())
+    ok = True
+
+    for challenge in challenges:
+        answer = table.get(challenge)
+        if answer is None or not pow_solver.check(challenge, answer, HARDNESS):
+            print(f'{challenge}: invalid answer {answer}', file=sys.stderr)
+            ok = False
+
+    # the stored answers are expected to be the smallest ones
+    for challenge in random.sample(challenges, min(sample, len(challenges))):
+        answer, expected = table.get(challenge), pow_solver.solve(challenge, HARDNESS)
+        if answer != expected:
+            print(f'{challenge}: answer {answer} is not the first one ({expected})', file=sys.stderr)
+            ok = False
+
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precomputed captcha answers table')
+    parser.add_argument('--table', default=TABLE_PATH, help='table file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='build the table, mining missing answers')
+    build_parser.add_argument('--json', default=JSON_PATH, help='known answers in json')
+
+    verify_parser = subparsers.add_parser('verify', help='check every answer in the table')
+    verify_parser.add_argument('--sample', type=int, default=16, help='answers to recompute from scratch')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.json, args.table)
+    elif not verify(args.table, args.sample):
+        sys.exit(1)
@@ -1,6 +1,3 @@
-import hashlib
-import json
-import os
 import random
 
 import requests
@@ -8,6 +5,9 @@ import requests
 from checklib import BaseChecker
 from Cryptodome.Cipher import ChaCha20
 
+import captcha_table
+import pow_solver
+
 PORT = 8000
 
 
@@ -21,8 +21,8 @@ class ModelrnaLib:
         self.c = checker
         self.port = port
         self.host = host or self.c.host
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mine_results.json'), 'r') as f:
-            self.mine_answers = json.loads(f.read())
+        # Opened on first use, see captcha_table.py to rebuild it.
+        self.mine_answers = captcha_table.AnswerTable()
 
     def check_json_dict_response(self, resp, url, keys):
         err_msg = f"Invalid JSON response on {url}"
@@ -86,12 +86,20 @@ class ModelrnaLib:
         captcha_info = self.get_captcha(session)
         # answer = self.mine(captcha_info['captcha_challenge'], 5)
         answer = self.captcha_answer(captcha_info['captcha_challenge'])
+        if random.randint(0, 1) == 1:
+            # Solve captcha in the same request.
+            return self.make_prediction(session, vaccine_id, data, captcha_key=captcha_info['captcha_key'],
+                                        captcha_answer=str(answer))
         token = self.send_captcha(session, captcha_info['captcha_key'], str(answer))['captcha_token']
         return self.make_prediction(session, vaccine_id, data, token)
 
-    def make_prediction(self, session: requests.Session, vaccine_id, data, captcha_token):
-        resp = session.post(self.url + '/vaccine/' + vaccine_id + '/test',
-                            json=data, headers={'X-Captcha-Token': captcha_token})
+    def make_prediction(self, session: requests.Session, vaccine_id, data, captcha_token=None,
+                        captcha_key=None, captcha_answer=None):
+        if captcha_key is not None:
+            headers = {'X-Captcha-Key': captcha_key, 'X-Captcha-Answer': captcha_answer}
+        else:
+            headers = {'X-Captcha-Token': captcha_token}
+        resp = session.post(self.url + '/vaccine/' + vaccine_id + '/test', json=data, headers=headers)
         return self.check_json_dict_response(resp, '/vaccine/' + vaccine_id + '/test',
                                              ('test_id', 'prediction', 'prediction_probability'))
 
@@ -131,12 +139,7 @@ class ModelrnaLib:
         return cha.encrypt(model)
 
     def mine(self, message, size):
-        for x in range(10 ** 100):
-            s = message + str(x)
-            s = s.encode()
-            hsh = hashlib.sha256(s).hexdigest()
-            if hsh.startswith('0' * size):
-                return x
+        return pow_solver.solve(message, size)
 
     def captcha_answer(self, message):
         answer = self.mine_answers.get(message)
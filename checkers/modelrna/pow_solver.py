@@ -0,0 +1,60 @@
+import os
+import hashlib
+import itertools
+import collections
+
+from concurrent.futures import ProcessPoolExecutor
+
+CHUNK_SIZE = 1 << 15
+
+
+def _matcher(size):
+    full, half = divmod(size, 2)
+    zeros = bytes(full)
+
+    if not half:
+        return lambda digest: digest[:full] == zeros
+    return lambda digest: digest[:full] == zeros and digest[full] < 0x10
+
+
+def check(message, answer, size=5):
+    return _matcher(size)(hashlib.sha256((message + str(answer)).encode()).digest())
+
+
+def search(message, size, start, stop):
+    # Same as sha256(message + str(x)).hexdigest().startswith('0' * size), but
+    # without rehashing the message and formatting hex for every candidate.
+    prefix = hashlib.sha256(message.encode())
+    matches = _matcher(size)
+    for x in range(start, stop):
+        h = prefix.copy()
+        h.update(str(x).encode())
+        if matches(h.digest()):
+            return x
+    return None
+
+
+def solve(message, size=5, workers=None, chunk_size=CHUNK_SIZE):
+    # Returns the smallest answer, so the result is the same as a sequential search.
+    workers = workers or os.cpu_count() or 1
+    starts = itertools.count(0, chunk_size)
+
+    if workers == 1:
+        for start in starts:
+            answer = search(message, size, start, start + chunk_size)
+            if answer is not None:
+                return answer
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque(
+            pool.submit(search, message, size, start, start + chunk_size)
+            for start in itertools.islice(starts, workers * 2)
+        )
+        while True:
+            answer = pending.popleft().result()
+            if answer is not None:
+                for future in pending:
+                    future.cancel()
+                return answer
+            start = next(starts)
+            pending.append(pool.submit(search, message, size, start, start + chunk_size))
@@ -3,10 +3,12 @@
 import os
 import abc
 import base64
+import typing
 import contextlib
 import websockets.client as ws
 
 import openssl
+import keypool
 
 
 class ChannelException(Exception):
@@ -61,10 +63,14 @@ class WebsocketChannel(Channel):
 
 class EncryptedChannel(Channel):
     def __init__(
-            self, channel: Channel, openssl: openssl.OpenSSL,
+            self,
+            channel: Channel,
+            crypto: openssl.CryptoBackend,
+            keys: typing.Optional[keypool.KeyPool] = None,
     ) -> None:
         self.channel = channel
-        self.openssl = openssl
+        self.crypto = crypto
+        self.keys = keys
         self.shared_key: str = None
 
     async def establish(self) -> None:
@@ -75,23 +81,26 @@ class EncryptedChannel(Channel):
         except Exception:
             raise ChannelException('base64 error')
 
-        private_key = await self.openssl.generate_private_key()
+        if self.keys is not None:
+            private_key, my_public_key = await self.keys.get()
+        else:
+            private_key = await self.crypto.generate_private_key()
 
-        if len(private_key) == 0:
-            raise Exception('failed to generate private key')
+            if len(private_key) == 0:
+                raise Exception('failed to generate private key')
 
-        my_public_key = await self.openssl.get_public_key(private_key)
+            my_public_key = await self.crypto.get_public_key(private_key)
 
-        if len(my_public_key) == 0:
-            raise Exception('failed to get public key')
+            if len(my_public_key) == 0:
+                raise Exception('failed to get public key')
 
         my_public_key = base64.b64encode(my_public_key).decode()
 
-        key, self.shared_key = await self.openssl.derive_shared_key(
+        key, self.shared_key = await self.crypto.derive_shared_key(
             private_key, other_public_key,
         )
 
-        if len(key) == 0 or len(self.shared_key) < self.openssl.KEY_SIZE:
+        if len(key) == 0 or len(self.shared_key) < self.crypto.KEY_SIZE:
             raise ChannelException('derive shared key error')
 
         await self.channel.sendline(my_public_key)
@@ -102,7 +111,7 @@ class EncryptedChannel(Channel):
 
         line += os.linesep
 
-        ciphertext = await self.openssl.encrypt(
+        ciphertext = await self.crypto.encrypt(
             line.encode(), self.shared_key,
         )
 
@@ -121,7 +130,7 @@ class EncryptedChannel(Channel):
         except Exception:
             raise ChannelException('base64 error')
 
-        plaintext = await self.openssl.decrypt(
+        plaintext = await self.crypto.decrypt(
             ciphertext, self.shared_key
         )
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import json
 import typing
@@ -12,7 +13,9 @@ import checklib.status as checklib
 import checklib.generators as generators
 import websockets.exceptions
 
+import native
 import openssl
+import keypool
 import channel
 import protocol
 
@@ -38,7 +41,7 @@ def print_diff(expected: typing.Any, actual: typing.Any) -> str:
 
 
 async def check_protocol_response(
-        coroutine: typing.Coroutine, expected_response: typing.Any, error_message: str,
+        coroutine: typing.Awaitable, expected_response: typing.Any, error_message: str,
 ) -> None:
     response = await coroutine
 
@@ -49,26 +52,58 @@ async def check_protocol_response(
         raise protocol.ProtocolException(error_message, print_diff(expected_response, response))
 
 
+CRYPTO_BACKENDS = {
+    'native': native.NativeCrypto,
+    'openssl': openssl.OpenSSL,
+}
+
+
 class Checker:
     vulns: int = 2
     timeout: int = 59
     uses_attack_data: bool = True
-
-    def __init__(self, host: str, openssl: openssl.OpenSSL) -> None:
+    crypto_backend: str = os.getenv('VIRUSH_CRYPTO_BACKEND', 'native')
+    key_pool_size: int = int(os.getenv('VIRUSH_KEY_POOL_SIZE', '2'))
+    key_pool_concurrency: int = int(os.getenv('VIRUSH_KEY_POOL_CONCURRENCY', '1'))
+    # number of connections each action opens, i.e. keypairs it needs
+    action_connections: typing.Dict[str, int] = {
+        'info': 0, 'check': 1, 'put': 1, 'get': 1,
+    }
+
+    def __init__(
+            self,
+            host: str,
+            crypto: openssl.CryptoBackend,
+            keys: typing.Optional[keypool.KeyPool],
+    ) -> None:
         self.host = host
         self.port = 17171
         self.uri = f'ws://{self.host}:{self.port}/api/'
-        self.openssl = openssl
+        self.crypto = crypto
+        self.keys = keys
 
     @contextlib.asynccontextmanager
-    async def create(host: str):
-        async with openssl.OpenSSL.create() as ssl:
-            yield Checker(host, ssl)
+    async def create(host: str, action: str):
+        backend = CRYPTO_BACKENDS[Checker.crypto_backend]
+        connections = Checker.action_connections.get(action, 0)
+
+        async with backend.create() as crypto:
+            if connections == 0:
+                yield Checker(host, crypto, None)
+                return
+
+            async with keypool.KeyPool.create(
+                    crypto,
+                    min(Checker.key_pool_size, connections),
+                    min(Checker.key_pool_concurrency, connections),
+                    connections,
+            ) as keys:
+                yield Checker(host, crypto, keys)
 
     @contextlib.asynccontextmanager
     async def connection(self, user_agent: str = 'checker'):
         async with channel.WebsocketChannel.create(self.uri, user_agent) as ws:
-            _channel = channel.EncryptedChannel(ws, self.openssl)
+            _channel = channel.EncryptedChannel(ws, self.crypto, self.keys)
             await _channel.establish()
 
             proto = protocol.VirushProtocol(_channel)
@@ -126,48 +161,31 @@ class Checker:
         value2 = generators.rnd_string(20)
 
         async with self.connection() as proto:
-            await check_protocol_response(
-                proto.ping(), protocol.PingResponse.SUCCESS, 'failed to ping',
-            )
-            await check_protocol_response(
-                proto.login(username1, password1), protocol.LoginResponse.DOES_NOT_EXIST, 'incorrect login behaviour',
-            )
-            await check_protocol_response(
-                proto.register(username1, password1), protocol.RegisterResponse.SUCCESS, 'failed to register',
-            )
-            await check_protocol_response(
-                proto.register(username1, password1), protocol.RegisterResponse.ALREADY_REGISTERED, 'incorrect register behaviour',
-            )
-            await check_protocol_response(
-                proto.login(username1, password2), protocol.LoginResponse.INVALID_PASSWORD, 'incorrect login behaviour',
-            )
-            await check_protocol_response(
-                proto.login(username1, password1), protocol.LoginResponse.SUCCESS, 'failed to login',
-            )
-            await check_protocol_response(
-                proto.put(username2, property_name1, True, value1), protocol.PutResponse.WRONG_USER, 'incorrect put behaviour',
-            )
-            await check_protocol_response(
-                proto.put(username1, property_name1, True, value1), protocol.PutResponse.SUCCESS, 'failed to put',
-            )
-            await check_protocol_response(
-                proto.put(username1, property_name1, True, value2), protocol.PutResponse.PROPERTY_ALREADY_EXISTS, 'incorrect put behaviour',
-            )
-            await check_protocol_response(
-                proto.get(username2, property_name1, False), protocol.GetResponse.USER_DOES_NOT_EXIST, 'incorrect get behaviour',
-            )
-            await check_protocol_response(
-                proto.get(username1, property_name2, True), protocol.GetResponse.PROPERTY_DOES_NOT_EXIST, 'incorrect get behaviour',
-            )
-            await check_protocol_response(
-                proto.get(username1, property_name1, True), protocol.GetResponse.SUCCESS, 'failed to get',
-            )
-            await check_protocol_response(
-                proto.logout(), protocol.LogoutResponse.SUCCESS, 'failed to logout',
-            )
-            await check_protocol_response(
-                proto.get(username1, property_name1, False), protocol.GetResponse.SUCCESS, 'failed to get',
-            )
+            batch = proto.batch()
+
+            responses = [
+                (batch.ping(), protocol.PingResponse.SUCCESS, 'failed to ping'),
+                (batch.login(username1, password1), protocol.LoginResponse.DOES_NOT_EXIST, 'incorrect login behaviour'),
+                (batch.register(username1, password1), protocol.RegisterResponse.SUCCESS, 'failed to register'),
+                (batch.register(username1, password1), protocol.RegisterResponse.ALREADY_REGISTERED, 'incorrect register behaviour'),
+                (batch.login(username1, password2), protocol.LoginResponse.INVALID_PASSWORD, 'incorrect login behaviour'),
+                (batch.login(username1, password1), protocol.LoginResponse.SUCCESS, 'failed to login'),
+                (batch.put(username2, property_name1, True, value1), protocol.PutResponse.WRONG_USER, 'incorrect put behaviour'),
+                (batch.put(username1, property_name1, True, value1), protocol.PutResponse.SUCCESS, 'failed to put'),
+                (batch.put(username1, property_name1, True, value2), protocol.PutResponse.PROPERTY_ALREADY_EXISTS, 'incorrect put behaviour'),
+                (batch.get(username2, property_name1, False), protocol.GetResponse.USER_DOES_NOT_EXIST, 'incorrect get behaviour'),
+                (batch.get(username1, property_name2, True), protocol.GetResponse.PROPERTY_DOES_NOT_EXIST, 'incorrect get behaviour'),
+                (batch.get(username1, property_name1, True), protocol.GetResponse.SUCCESS, 'failed to get'),
+                (batch.logout(), protocol.LogoutResponse.SUCCESS, 'failed to logout'),
+                (batch.get(username1, property_name1, False), protocol.GetResponse.SUCCESS, 'failed to get'),
+            ]
+
+            await batch.flush()
+
+            for response, expected_response, error_message in responses:
+                await check_protocol_response(
+                    response, expected_response, error_message,
+                )
 
         return Verdict(checklib.Status.OK)
 
@@ -274,7 +292,7 @@ class Checker:
         except Exception:
             return Verdict(checklib.Status.MUMBLE, 'incorrect storage encoding')
 
-        plaintext = await self.openssl.decrypt(ciphertext, password)
+        plaintext = await self.crypto.decrypt(ciphertext, password)
         if len(plaintext) == 0:
             return Verdict(checklib.Status.MUMBLE, 'incorrect storage encryption')
 
@@ -324,7 +342,7 @@ class Checker:
 async def main():
     action, host, *arguments = sys.argv[1:]
 
-    async with Checker.create(host) as checker:
+    async with Checker.create(host, action) as checker:
         verdict = await checker.action(action, *arguments)
 
     print(verdict.public, file=sys.stdout)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import typing
+import asyncio
+import contextlib
+
+import openssl
+
+
+KeyPair = typing.Tuple[bytes, bytes]
+
+
+class KeyPool:
+    def __init__(
+            self,
+            crypto: openssl.CryptoBackend,
+            size: int,
+            concurrency: int,
+            limit: typing.Optional[int] = None,
+    ) -> None:
+        self.crypto = crypto
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, size))
+        # total number of keypairs to generate, keys nobody is going
+        # to take are not worth stalling the event loop for
+        self.remaining = limit
+        self.workers = [
+            asyncio.create_task(self.refill())
+            for _ in range(max(1, concurrency))
+        ]
+
+    @contextlib.asynccontextmanager
+    async def create(
+            crypto: openssl.CryptoBackend,
+            size: int = 2,
+            concurrency: int = 1,
+            limit: typing.Optional[int] = None,
+    ):
+        pool = KeyPool(crypto, size, concurrency, limit)
+
+        try:
+            yield pool
+        finally:
+            for worker in pool.workers:
+                worker.cancel()
+
+            await asyncio.gather(*pool.workers, return_exceptions=True)
+
+    async def generate(self) -> KeyPair:
+        private_key = await self.crypto.generate_private_key()
+
+        if len(private_key) == 0:
+            raise Exception('failed to generate private key')
+
+        public_key = await self.crypto.get_public_key(private_key)
+
+        if len(public_key) == 0:
+            raise Exception('failed to get public key')
+
+        return private_key, public_key
+
+    async def refill(self) -> None:
+        while self.remaining is None or self.remaining > 0:
+            if self.remaining is not None:
+                self.remaining -= 1
+
+            keypair = await self.generate()
+            await self.queue.put(keypair)
+
+    async def get(self) -> KeyPair:
+        while True:
+            with contextlib.suppress(asyncio.QueueEmpty):
+                return self.queue.get_nowait()
+
+            workers = [worker for worker in self.workers if not worker.done()]
+
+            if len(workers) == 0:
+                # all refill workers have failed, generate in place
+                # so the error is raised to the caller
+                return await self.generate()
+
+            getter = asyncio.create_task(self.queue.get())
+            done, _ = await asyncio.wait(
+                [getter, *workers], return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            if getter in done:
+                return getter.result()
+
+            getter.cancel()
+            await asyncio.gather(getter, return_exceptions=True)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import typing
+import secrets
+import hashlib
+import contextlib
+
+from Crypto.Cipher import AES
+from Crypto.IO import PEM
+from Crypto.Util import asn1, Padding
+
+import openssl
+
+
+class NativeCrypto(openssl.CryptoBackend):
+    SALT_MAGIC = b'Salted__'
+    SALT_SIZE = 8
+    PBKDF2_DIGEST = 'sha256'
+    PBKDF2_ITERATIONS = 16
+    DH_KEY_AGREEMENT_OID = '1.2.840.113549.1.3.1'
+
+    def __init__(self, param_file: str = openssl.DH_PARAM_FILE) -> None:
+        with open(param_file, 'r') as file:
+            self.prime, self.generator = self.load_parameters(file.read())
+
+    @contextlib.asynccontextmanager
+    async def create():
+        yield NativeCrypto()
+
+    @staticmethod
+    def load_parameters(pem: str) -> typing.Tuple[int, int]:
+        der, _, _ = PEM.decode(pem)
+
+        prime, generator, *_ = asn1.DerSequence().decode(der)
+
+        return prime, generator
+
+    def encode_public_key(self, public_value: int) -> bytes:
+        algorithm = asn1.DerSequence([
+            asn1.DerObjectId(self.DH_KEY_AGREEMENT_OID),
+            asn1.DerSequence([self.prime, self.generator]),
+        ])
+
+        public_key = asn1.DerBitString(asn1.DerInteger(public_value).encode())
+
+        return asn1.DerSequence([algorithm, public_key]).encode()
+
+    def decode_public_key(self, public_key: bytes) -> int:
+        algorithm, bit_string = asn1.DerSequence().decode(public_key)
+
+        oid, parameters = asn1.DerSequence().decode(algorithm)
+
+        if asn1.DerObjectId().decode(oid).value != self.DH_KEY_AGREEMENT_OID:
+            raise ValueError('invalid public key algorithm')
+
+        prime, generator, *_ = asn1.DerSequence().decode(parameters)
+
+        if (prime, generator) != (self.prime, self.generator):
+            raise ValueError('invalid public key parameters')
+
+        value = asn1.DerBitString().decode(bit_string).value
+
+        return asn1.DerInteger().decode(value).value
+
+    def derive_cipher_key(self, key: str, salt: bytes) -> bytes:
+        return hashlib.pbkdf2_hmac(
+            self.PBKDF2_DIGEST, key.encode(), salt, self.PBKDF2_ITERATIONS,
+            dklen=2 * self.BLOCK_SIZE,
+        )[:self.BLOCK_SIZE]
+
+    async def generate_private_key(self) -> bytes:
+        private_value = 2 + secrets.randbelow(self.prime - 3)
+
+        return private_value.to_bytes((self.prime.bit_length() + 7) // 8, 'big')
+
+    async def get_public_key(self, private_key: bytes) -> bytes:
+        private_value = int.from_bytes(private_key, 'big')
+        public_value = pow(self.generator, private_value, self.prime)
+
+        return self.encode_public_key(public_value)
+
+    async def derive_shared_key(
+            self, private_key: bytes, other_public_key: bytes,
+    ) -> typing.Tuple[bytes, str]:
+        try:
+            other_public_value = self.decode_public_key(other_public_key)
+        except (ValueError, EOFError):
+            return b'', ''
+
+        if not 1 < other_public_value < self.prime - 1:
+            return b'', ''
+
+        private_value = int.from_bytes(private_key, 'big')
+        shared_value = pow(other_public_value, private_value, self.prime)
+
+        # openssl pkeyutl -derive strips leading zero bytes
+        shared_key = shared_value.to_bytes(
+            (shared_value.bit_length() + 7) // 8, 'big',
+        )
+
+        return shared_key, hashlib.sha256(shared_key).hexdigest()
+
+    async def encrypt(self, plaintext: bytes, key: str) -> bytes:
+        iv = os.urandom(self.BLOCK_SIZE)
+        salt = os.urandom(self.SALT_SIZE)
+
+        cipher = AES.new(
+            self.derive_cipher_key(key, salt), AES.MODE_CBC, iv=iv,
+        )
+        ciphertext = cipher.encrypt(Padding.pad(plaintext, self.BLOCK_SIZE))
+
+        return iv + self.SALT_MAGIC + salt + ciphertext
+
+    async def decrypt(self, ciphertext: bytes, key: str) -> bytes:
+        iv, ciphertext = (
+            ciphertext[:self.BLOCK_SIZE], ciphertext[self.BLOCK_SIZE:],
+        )
+
+        header_size = len(self.SALT_MAGIC) + self.SALT_SIZE
+        magic, salt, ciphertext = (
+            ciphertext[:len(self.SALT_MAGIC)],
+            ciphertext[len(self.SALT_MAGIC):header_size],
+            ciphertext[header_size:],
+        )
+
+        if len(iv) != self.BLOCK_SIZE or magic != self.SALT_MAGIC:
+            return b''
+
+        if len(ciphertext) == 0 or len(ciphertext) % self.BLOCK_SIZE != 0:
+            return b''
+
+        cipher = AES.new(
+            self.derive_cipher_key(key, salt), AES.MODE_CBC, iv=iv,
+        )
+
+        try:
+            return Padding.unpad(cipher.decrypt(ciphertext), self.BLOCK_SIZE)
+        except ValueError:
+            return b''
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import os
+import abc
 import shlex
 import typing
+import secrets
 import asyncio
 import hashlib
 import tempfile
@@ -14,14 +16,58 @@ DH_PARAM_FILE = os.path.join(
     'dhparam.pem',
 )
 
-class OpenSSL:
-    TIMEOUT = 0.2
-    ALGORITHM = 'aes-128-cbc'
+class CryptoBackend(abc.ABC):
     KEY_SIZE = 32
     BLOCK_SIZE = 16
 
+    @abc.abstractmethod
+    async def generate_private_key(self) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    async def get_public_key(self, private_key: bytes) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    async def derive_shared_key(
+            self, private_key: bytes, other_public_key: bytes,
+    ) -> typing.Tuple[bytes, str]:
+        pass
+
+    @abc.abstractmethod
+    async def encrypt(self, plaintext: bytes, key: str) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    async def decrypt(self, ciphertext: bytes, key: str) -> bytes:
+        pass
+
+
+@contextlib.contextmanager
+def temporary_files(*contents: bytes):
+    paths = []
+
+    try:
+        for content in contents:
+            fd, path = tempfile.mkstemp()
+            paths.append(path)
+
+            with os.fdopen(fd, 'wb') as file:
+                file.write(content)
+
+        yield paths
+    finally:
+        for path in paths:
+            os.unlink(path)
+
+
+class OpenSSL(CryptoBackend):
+    PROMPT = b'OpenSSL> '
+    ALGORITHM = 'aes-128-cbc'
+
     def __init__(self, process: asyncio.subprocess.Process) -> None:
         self.process = process
+        self.lock = asyncio.Lock()
 
     @contextlib.asynccontextmanager
     async def create():
@@ -29,10 +75,12 @@ class OpenSSL:
             'openssl',
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
         )
 
         try:
+            await process.stdout.readuntil(OpenSSL.PROMPT)
+
             yield OpenSSL(process)
         finally:
             try:
@@ -41,136 +89,81 @@ class OpenSSL:
             except Exception:
                 pass
 
-    async def execute(self, arguments: typing.Iterable[str]) -> None:
+    async def execute(self, arguments: typing.Iterable[str]) -> bytes:
         command = shlex.join(arguments)
 
-        await self.process.stdout.readexactly(len('OpenSSL> '))
+        # `passwd` echoes the random salt back, so its output marks the end
+        # of the command output even if the output contains a prompt
+        nonce = secrets.token_hex(4)
+        marker = self.PROMPT + f'$1${nonce}$'.encode()
+        completion = shlex.join(['passwd', '-1', '-salt', nonce, nonce])
 
-        self.process.stdin.write(f'{command}{os.linesep}'.encode())
-        await self.process.stdin.drain()
+        async with self.lock:
+            self.process.stdin.write(
+                f'{command}{os.linesep}{completion}{os.linesep}'.encode(),
+            )
+            await self.process.stdin.drain()
 
-        await asyncio.sleep(self.TIMEOUT)
+            output = await self.process.stdout.readuntil(marker)
+            await self.process.stdout.readuntil(b'\n' + self.PROMPT)
 
-    async def generate_private_key(self) -> bytes:
-        _, private_key_file = tempfile.mkstemp()
+        return output[:-len(marker)]
 
-        await self.execute([
+    async def generate_private_key(self) -> bytes:
+        return await self.execute([
             'genpkey',
             '-paramfile', DH_PARAM_FILE,
-            '-out', private_key_file,
         ])
 
-        with open(private_key_file, 'rb') as file:
-            private_key = file.read()
-
-        os.unlink(private_key_file)
-
-        return private_key
-
     async def get_public_key(self, private_key: bytes) -> bytes:
-        _, private_key_file = tempfile.mkstemp()
-        _, public_key_file = tempfile.mkstemp()
-
-        with open(private_key_file, 'wb') as file:
-            file.write(private_key)
-
-        await self.execute([
-            'pkey',
-            '-in', private_key_file,
-            '-pubout',
-            '-out', public_key_file,
-            '-outform', 'DER',
-        ])
-
-        with open(public_key_file, 'rb') as file:
-            public_key = file.read()
-
-        os.unlink(public_key_file)
-        os.unlink(private_key_file)
-
-        return public_key
+        with temporary_files(private_key) as (private_key_file, ):
+            return await self.execute([
+                'pkey',
+                '-in', private_key_file,
+                '-pubout',
+                '-outform', 'DER',
+            ])
 
     async def derive_shared_key(
             self, private_key: bytes, other_public_key: bytes,
-    ) -> str:
-        _, private_key_file = tempfile.mkstemp()
-        _, other_public_key_file = tempfile.mkstemp()
-        _, shared_key_file = tempfile.mkstemp()
-
-        with open(private_key_file, 'wb') as file:
-            file.write(private_key)
-
-        with open(other_public_key_file, 'wb') as file:
-            file.write(other_public_key)
-
-        await self.execute([
-            'pkeyutl',
-            '-inkey', private_key_file,
-            '-derive',
-            '-peerkey', other_public_key_file,
-            '-peerform', 'DER',
-            '-out', shared_key_file,
-        ])
-
-        with open(shared_key_file, 'rb') as file:
-            shared_key = file.read()
-
-        os.unlink(shared_key_file)
-        os.unlink(other_public_key_file)
-        os.unlink(private_key_file)
+    ) -> typing.Tuple[bytes, str]:
+        files = temporary_files(private_key, other_public_key)
+
+        with files as (private_key_file, other_public_key_file):
+            shared_key = await self.execute([
+                'pkeyutl',
+                '-inkey', private_key_file,
+                '-derive',
+                '-peerkey', other_public_key_file,
+                '-peerform', 'DER',
+            ])
 
         return shared_key, hashlib.sha256(shared_key).hexdigest()
 
     async def encrypt(self, plaintext: bytes, key: str) -> bytes:
-        _, plaintext_file = tempfile.mkstemp()
-        _, ciphertext_file = tempfile.mkstemp()
-
-        with open(plaintext_file, 'wb') as file:
-            file.write(plaintext)
-
         iv = os.urandom(self.BLOCK_SIZE)
 
-        await self.execute([
-            self.ALGORITHM, '-e',
-            '-iter', '16',
-            '-k', key,
-            '-iv', iv.hex(),
-            '-in', plaintext_file,
-            '-out', ciphertext_file,
-        ])
-
-        with open(ciphertext_file, 'rb') as file:
-            ciphertext = file.read()
-
-        os.unlink(ciphertext_file)
-        os.unlink(plaintext_file)
+        with temporary_files(plaintext) as (plaintext_file, ):
+            ciphertext = await self.execute([
+                self.ALGORITHM, '-e',
+                '-iter', '16',
+                '-k', key,
+                '-iv', iv.hex(),
+                '-in', plaintext_file,
+            ])
 
         return iv + ciphertext
 
     async def decrypt(self, ciphertext: bytes, key: str) -> bytes:
-        _, ciphertext_file = tempfile.mkstemp()
-        _, plaintext_file = tempfile.mkstemp()
-
         iv, ciphertext = (
             ciphertext[:self.BLOCK_SIZE], ciphertext[self.BLOCK_SIZE:],
         )
 
-        with open(ciphertext_file, 'wb') as file:
-            file.write(ciphertext)
-
-        await self.execute([
-            self.ALGORITHM, '-d',
-            '-iter', '16',
-            '-k', key,
-            '-iv', iv.hex(),
-            '-in', ciphertext_file,
-            '-out', plaintext_file,
-        ])
-
-        with open(plaintext_file, 'rb') as file:
-            plaintext = file.read()
-
-        os.unlink(plaintext_file)
-        os.unlink(ciphertext_file)
-
-        return plaintext
+        with temporary_files(ciphertext) as (ciphertext_file, ):
+            return await self.execute([
+                self.ALGORITHM, '-d',
+                '-iter', '16',
+                '-k', key,
+                '-iv', iv.hex(),
+                '-in', ciphertext_file,
+            ])
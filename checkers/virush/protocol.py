@@ -51,114 +51,259 @@ class ExitResponse(enum.Enum):
     SUCCESS = enum.auto()
 
 
+class Request:
+    def __init__(
+            self,
+            lines: typing.List[str],
+            handler: typing.Callable[[], typing.Awaitable[typing.Any]],
+            barrier: bool = False,
+    ) -> None:
+        self.lines = lines
+        self.handler = handler
+        # nothing can be sent after a barrier request until it is handled
+        self.barrier = barrier
+
+
+class PendingResponse:
+    def __init__(self) -> None:
+        self.done = False
+        self.result: typing.Any = None
+        self.error: typing.Optional[Exception] = None
+
+    def set_result(self, result: typing.Any) -> None:
+        self.done, self.result = True, result
+
+    def set_error(self, error: Exception) -> None:
+        self.done, self.error = True, error
+
+    async def get(self) -> typing.Any:
+        if not self.done:
+            raise Exception('batch has not been flushed')
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+    def __await__(self):
+        return self.get().__await__()
+
+
+class VirushBatch:
+    def __init__(self, protocol: 'VirushProtocol') -> None:
+        self.protocol = protocol
+        self.queue: typing.List[typing.Tuple[Request, PendingResponse]] = []
+
+    def add(self, request: Request) -> PendingResponse:
+        pending = PendingResponse()
+        self.queue.append((request, pending))
+
+        return pending
+
+    def ping(self) -> PendingResponse:
+        return self.add(self.protocol.ping_request())
+
+    def register(self, username: str, password: str) -> PendingResponse:
+        return self.add(self.protocol.register_request(username, password))
+
+    def login(self, username: str, password: str) -> PendingResponse:
+        return self.add(self.protocol.login_request(username, password))
+
+    def logout(self) -> PendingResponse:
+        return self.add(self.protocol.logout_request())
+
+    def get(
+            self, username: str, property_name: str, encrypted: bool,
+    ) -> PendingResponse:
+        return self.add(
+            self.protocol.get_request(username, property_name, encrypted),
+        )
+
+    def put(
+            self, username: str, property_name: str, encrypted: bool, data: str = '',
+    ) -> PendingResponse:
+        return self.add(
+            self.protocol.put_request(username, property_name, encrypted, data),
+        )
+
+    def exit(self) -> PendingResponse:
+        return self.add(self.protocol.exit_request())
+
+    async def flush(self) -> None:
+        queue, self.queue = self.queue, []
+        position = 0
+
+        for index, (request, pending) in enumerate(queue):
+            try:
+                while position < len(queue):
+                    if position > index and queue[position - 1][0].barrier:
+                        break
+
+                    for line in queue[position][0].lines:
+                        await self.protocol.channel.sendline(line)
+
+                    position += 1
+
+                pending.set_result(await request.handler())
+            except Exception as error:
+                for _, rest in queue[index:]:
+                    rest.set_error(error)
+
+                return
+
+
 class VirushProtocol:
     def __init__(self, channel: channel.Channel) -> None:
         self.channel = channel
 
+    async def execute(self, request: Request) -> typing.Any:
+        for line in request.lines:
+            await self.channel.sendline(line)
+
+        return await request.handler()
+
+    def batch(self) -> VirushBatch:
+        return VirushBatch(self)
+
     async def ping(self) -> PingResponse:
-        await self.channel.sendline(f'PING')
+        return await self.execute(self.ping_request())
+
+    def ping_request(self) -> Request:
+        async def handler() -> PingResponse:
+            response = await self.channel.recvline()
 
-        response = await self.channel.recvline()
+            if response == f'SUCCESS: PONG':
+                return PingResponse.SUCCESS
 
-        if response == f'SUCCESS: PONG':
-            return PingResponse.SUCCESS
+            raise ProtocolException('wrong response for ping', response)
 
-        raise ProtocolException('wrong response for ping', response)
+        return Request([f'PING'], handler)
 
     async def register(self, username: str, password: str) -> RegisterResponse:
-        await self.channel.sendline(f'REGISTER')
-        await self.channel.sendline(f'{username} {password}')
+        return await self.execute(self.register_request(username, password))
+
+    def register_request(self, username: str, password: str) -> Request:
+        async def handler() -> RegisterResponse:
+            response = await self.channel.recvline()
 
-        response = await self.channel.recvline()
+            if response == f'ERROR: USER {username} IS ALREADY REGISTERED':
+                return RegisterResponse.ALREADY_REGISTERED
+            elif response == f'SUCCESS: USER {username} HAS BEEN REGISTERED':
+                return RegisterResponse.SUCCESS
 
-        if response == f'ERROR: USER {username} IS ALREADY REGISTERED':
-            return RegisterResponse.ALREADY_REGISTERED
-        elif response == f'SUCCESS: USER {username} HAS BEEN REGISTERED':
-            return RegisterResponse.SUCCESS
+            raise ProtocolException('wrong response for register', response)
 
-        raise ProtocolException('wrong response for register', response)
+        return Request([f'REGISTER', f'{username} {password}'], handler)
 
     async def login(self, username: str, password: str) -> LoginResponse:
-        await self.channel.sendline(f'LOGIN')
-        await self.channel.sendline(f'{username} {password}')
+        return await self.execute(self.login_request(username, password))
 
-        response = await self.channel.recvline()
+    def login_request(self, username: str, password: str) -> Request:
+        async def handler() -> LoginResponse:
+            response = await self.channel.recvline()
 
-        if response == f'ERROR: USER {username} DOES NOT EXIST':
-            return LoginResponse.DOES_NOT_EXIST
-        elif response == f'ERROR: INVALID PASSWORD FOR USER {username}':
-            return LoginResponse.INVALID_PASSWORD
-        elif response == f'SUCCESS: LOGGED IN AS {username}':
-            return LoginResponse.SUCCESS
+            if response == f'ERROR: USER {username} DOES NOT EXIST':
+                return LoginResponse.DOES_NOT_EXIST
+            elif response == f'ERROR: INVALID PASSWORD FOR USER {username}':
+                return LoginResponse.INVALID_PASSWORD
+            elif response == f'SUCCESS: LOGGED IN AS {username}':
+                return LoginResponse.SUCCESS
 
-        raise ProtocolException('wrong response for login', response)
+            raise ProtocolException('wrong response for login', response)
+
+        return Request([f'LOGIN', f'{username} {password}'], handler)
 
     async def logout(self) -> LogoutResponse:
-        await self.channel.sendline(f'LOGOUT')
+        return await self.execute(self.logout_request())
+
+    def logout_request(self) -> Request:
+        async def handler() -> LogoutResponse:
+            response = await self.channel.recvline()
 
-        response = await self.channel.recvline()
+            if response == f'SUCCESS: LOGGED OUT':
+                return LogoutResponse.SUCCESS
 
-        if response == f'SUCCESS: LOGGED OUT':
-            return LogoutResponse.SUCCESS
+            raise ProtocolException('wrong response for logout', response)
 
-        raise ProtocolException('wrong response for logout', response)
+        return Request([f'LOGOUT'], handler)
 
     async def get(
             self, username: str, property_name: str, encrypted: bool,
     ) -> typing.Tuple[GetResponse, typing.Optional[str]]:
+        return await self.execute(
+            self.get_request(username, property_name, encrypted),
+        )
+
+    def get_request(
+            self, username: str, property_name: str, encrypted: bool,
+    ) -> Request:
         mode = 'ENCRYPTED' if encrypted else ''
 
-        await self.channel.sendline(f'GET')
-        await self.channel.sendline(f'{username} {property_name} {mode}')
+        async def handler() -> typing.Tuple[GetResponse, typing.Optional[str]]:
+            response = await self.channel.recvline()
 
-        response = await self.channel.recvline()
+            if response == f'ERROR: USER {username} DOES NOT EXIST':
+                result = GetResponse.USER_DOES_NOT_EXIST
+            elif response == f'ERROR: {property_name} DOES NOT EXIST FOR USER {username}':
+                result = GetResponse.PROPERTY_DOES_NOT_EXIST
+            elif response == f'SUCCESS: TRYING TO GET {property_name} FROM USER {username}':
+                result = GetResponse.SUCCESS
+            else:
+                raise ProtocolException('wrong response for get', response)
 
-        if response == f'ERROR: USER {username} DOES NOT EXIST':
-            result = GetResponse.USER_DOES_NOT_EXIST
-        elif response == f'ERROR: {property_name} DOES NOT EXIST FOR USER {username}':
-            result = GetResponse.PROPERTY_DOES_NOT_EXIST
-        elif response == f'SUCCESS: TRYING TO GET {property_name} FROM USER {username}':
-            result = GetResponse.SUCCESS
-        else:
-            raise ProtocolException('wrong response for get', response)
+            return result, (
+                await self.channel.recvline()
+                if result is GetResponse.SUCCESS
+                else None
+            )
 
-        return result, (
-            await self.channel.recvline()
-            if result is GetResponse.SUCCESS
-            else None
-        )
+        return Request([f'GET', f'{username} {property_name} {mode}'], handler)
 
     async def put(
             self, username: str, property_name: str, encrypted: bool, data: str = '',
     ) -> PutResponse:
+        return await self.execute(
+            self.put_request(username, property_name, encrypted, data),
+        )
+
+    def put_request(
+            self, username: str, property_name: str, encrypted: bool, data: str = '',
+    ) -> Request:
         mode = 'ENCRYPTED' if encrypted else ''
 
-        await self.channel.sendline(f'PUT')
-        await self.channel.sendline(f'{username} {property_name} {mode}')
+        async def handler() -> PutResponse:
+            response = await self.channel.recvline()
 
-        response = await self.channel.recvline()
+            if response == f'ERROR: YOU ARE NOT {username}':
+                return PutResponse.WRONG_USER
+            elif response == f'ERROR: USER {username} DOES NOT EXIST':
+                return PutResponse.USER_DOES_NOT_EXIST
+            elif response == f'ERROR: {property_name} ALREADY EXISTS FOR USER {username}':
+                return PutResponse.PROPERTY_ALREADY_EXISTS
+            elif response == f'SUCCESS: TRYING TO PUT {property_name} TO USER {username}':
+                result = PutResponse.SUCCESS
+            else:
+                raise ProtocolException('wrong response for put', response)
 
-        if response == f'ERROR: YOU ARE NOT {username}':
-            return PutResponse.WRONG_USER
-        elif response == f'ERROR: USER {username} DOES NOT EXIST':
-            return PutResponse.USER_DOES_NOT_EXIST
-        elif response == f'ERROR: {property_name} ALREADY EXISTS FOR USER {username}':
-            return PutResponse.PROPERTY_ALREADY_EXISTS
-        elif response == f'SUCCESS: TRYING TO PUT {property_name} TO USER {username}':
-            result = PutResponse.SUCCESS
-        else:
-            raise ProtocolException('wrong response for put', response)
- 
-        await self.channel.sendline(data)
+            await self.channel.sendline(data)
 
-        return result
+            return result
+
+        # the data line is sent only after a successful response
+        return Request(
+            [f'PUT', f'{username} {property_name} {mode}'], handler, barrier=True,
+        )
 
     async def exit(self) -> None:
-        await self.channel.sendline(f'EXIT')
+        return await self.execute(self.exit_request())
+
+    def exit_request(self) -> Request:
+        async def handler() -> ExitResponse:
+            response = await self.channel.recvline()
 
-        response = await self.channel.recvline()
+            if response == f'SUCCESS: BYE':
+                return ExitResponse.SUCCESS
 
-        if response == f'SUCCESS: BYE':
-            return ExitResponse.SUCCESS
+            raise ProtocolException('wrong response for exit', response)
 
-        raise ProtocolException('wrong response for exit', response)
+        return Request([f'EXIT'], handler)
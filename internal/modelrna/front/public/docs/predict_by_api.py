@@ -1,8 +1,9 @@
-import hashlib
-
 import requests
 from Cryptodome.Cipher import ChaCha20
 
+# download it from /docs/pow_solver.py and keep it next to this script
+import pow_solver
+
 
 class ApiHelper:
     PORT = 8000
@@ -51,12 +52,7 @@ class ApiHelper:
         return self._send_prediction(vaccine_id, data, resp['captcha_token'])
 
     def mine(self, message, size):
-        for x in range(10 ** 100):
-            s = message + str(x)
-            s = s.encode()
-            hsh = hashlib.sha256(s).hexdigest()
-            if hsh.startswith('0' * size):
-                return x
+        return pow_solver.solve(message, size)
 
 
 HOST = "localhost"
@@ -72,7 +68,8 @@ YOUR_DATA = {
 
 VACCINE_ID = "<some_uuid>"
 
-client = ApiClient(HOST, None)
+if __name__ == '__main__':
+    client = ApiClient(HOST, None)
 
-response = client.send_prediction(VACCINE_ID, YOUR_DATA)
-print(response)
+    response = client.send_prediction(VACCINE_ID, YOUR_DATA)
+    print(response)
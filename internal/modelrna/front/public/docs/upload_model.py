@@ -1,8 +1,9 @@
-import hashlib
-
 import requests
 from Cryptodome.Cipher import ChaCha20
 
+# download it from /docs/pow_solver.py and keep it next to this script
+import pow_solver
+
 
 class ApiHelper:
     PORT = 8000
@@ -51,12 +52,7 @@ class ApiHelper:
         return self._send_prediction(vaccine_id, data, resp['captcha_token'])
 
     def mine(self, message, size):
-        for x in range(10 ** 100):
-            s = message + str(x)
-            s = s.encode()
-            hsh = hashlib.sha256(s).hexdigest()
-            if hsh.startswith('0' * size):
-                return x
+        return pow_solver.solve(message, size)
 
 
 PATH_TO_MODEL = "sample_model.onnx"
@@ -64,6 +60,7 @@ API_TOKEN = "<your_api_token>"
 VACCINE_KEY = "<your_vaccine_key>"
 HOST = "localhost"
 
-client = ApiClient(HOST, API_TOKEN)
-response = client.upload_model(VACCINE_KEY, PATH_TO_MODEL)
-print(response)
+if __name__ == '__main__':
+    client = ApiClient(HOST, API_TOKEN)
+    response = client.upload_model(VACCINE_KEY, PATH_TO_MODEL)
+    print(response)
@@ -0,0 +1,84 @@
+import csv
+import json
+import typing
+
+import pydantic
+
+from app.dto import CheckRequest
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-seq')
+CSV_TYPES = ('text/csv', 'application/csv')
+
+
+class BatchTooLargeError(ValueError):
+    pass
+
+
+async def iter_lines(stream: typing.AsyncIterator[bytes], max_bytes: int):
+    size = 0
+    tail = b''
+    async for chunk in stream:
+        size += len(chunk)
+        if size > max_bytes:
+            raise BatchTooLargeError("request body is too large (max {} bytes)".format(max_bytes))
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    yield tail
+
+
+async def iter_ndjson(stream, max_bytes):
+    async for line in iter_lines(stream, max_bytes):
+        if line.strip():
+            yield json.loads(line)
+
+
+async def iter_csv(stream, max_bytes):
+    header = None
+    async for line in iter_lines(stream, max_bytes):
+        if not line.strip():
+            continue
+        values = next(csv.reader([line.decode().rstrip('\r')]))
+        if header is None:
+            header = [x.strip() for x in values]
+            continue
+        row = dict(zip(header, values))
+        # datasets exported for training have no ssn column
+        row.setdefault('ssn', '')
+        yield row
+
+
+async def iter_json(stream, max_bytes):
+    body = b''
+    async for line in iter_lines(stream, max_bytes):
+        body += line + b'\n'
+    rows = json.loads(body)
+    if not isinstance(rows, list):
+        raise ValueError("expected a list of rows")
+    for row in rows:
+        yield row
+
+
+async def read_rows(content_type: str, stream, max_rows: int, max_bytes: int) -> typing.List[CheckRequest]:
+    content_type = content_type.split(';')[0].strip().lower()
+    if content_type in NDJSON_TYPES:
+        rows = iter_ndjson(stream, max_bytes)
+    elif content_type in CSV_TYPES:
+        rows = iter_csv(stream, max_bytes)
+    else:
+        rows = iter_json(stream, max_bytes)
+
+    out = []
+    async for row in rows:
+        if len(out) >= max_rows:
+            raise BatchTooLargeError("too many rows (max {})".format(max_rows))
+        if not isinstance(row, dict):
+            raise ValueError("row {}: expected an object".format(len(out)))
+        try:
+            out.append(CheckRequest(**row))
+        except pydantic.ValidationError as e:
+            raise ValueError("row {}: {}".format(len(out), e))
+    if not out:
+        raise ValueError("no rows provided")
+    return out
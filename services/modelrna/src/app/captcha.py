@@ -3,6 +3,7 @@ import random
 import hashlib
 import string
 
+from app import metrics
 from app.storage import Storage
 
 
@@ -20,13 +21,15 @@ class CaptchaHelper:
         return key, value
 
     async def check(self, key: str, answer: str):
-        challenge = await self.storage.get_challenge(key)
+        challenge = await self.storage.pop_challenge(key)
         if not challenge:
+            metrics.CAPTCHA_CHECKS.labels('challenge', 'expired').inc()
             raise KeyError("captcha not found or expired")
 
-        await self.storage.revoke_challenge(key)
         hsh = hashlib.sha256(challenge + answer.encode()).hexdigest()
-        return hsh.startswith('0' * self.HARDNESS)
+        is_ok = hsh.startswith('0' * self.HARDNESS)
+        metrics.CAPTCHA_CHECKS.labels('challenge', 'ok' if is_ok else 'invalid').inc()
+        return is_ok
 
     async def generate_token(self):
         token = str(uuid.uuid4())
@@ -34,8 +37,6 @@ class CaptchaHelper:
         return token
 
     async def check_token(self, token):
-        exists = await self.storage.check_captcha_token(token)
-        if not exists:
-            return False
-        await self.storage.remove_captcha_token(token)
-        return True
+        is_ok = await self.storage.pop_captcha_token(token)
+        metrics.CAPTCHA_CHECKS.labels('token', 'ok' if is_ok else 'invalid').inc()
+        return is_ok
@@ -1,6 +1,28 @@
-from celery import Celery
+import time
 
+from celery import Celery, signals
+
+from app import metrics
 from app.config import get_settings
 
 celery_app = Celery("celery_app", broker=get_settings().redis_celery_url,
                     result_backend=get_settings().redis_celery_url)
+
+_task_started = {}
+
+
+@signals.worker_ready.connect
+def start_metrics_server(**kwargs):
+    metrics.start_http_server(get_settings().metrics_port)
+
+
+@signals.task_prerun.connect
+def task_prerun(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@signals.task_postrun.connect
+def task_postrun(task_id=None, task=None, state=None, **kwargs):
+    start = _task_started.pop(task_id, None)
+    if start is not None:
+        metrics.CELERY_TASK_RUN_DURATION.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - start)
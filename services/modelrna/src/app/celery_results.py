@@ -0,0 +1,127 @@
+import time
+import uuid
+import asyncio
+import logging
+
+import aioredis
+from celery import states
+
+from app import metrics
+
+
+class ResultWaiter(object):
+    # Celery's redis backend publishes every stored result on a channel named after
+    # the result key, so results are awaited on a shared subscription instead of
+    # blocking a thread in AsyncResult.get(). The key is still polled from time to
+    # time in case a message is lost while the subscription is being restored.
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, redis_cli: aioredis.Redis, backend):
+        self.redis_cli = redis_cli
+        self.backend = backend
+        self.pubsub = None
+        self.reader = None
+        self.waiters = {}
+        # aioredis connects the pubsub lazily on the first command, concurrent
+        # first subscribes would each open a connection and only one is read
+        self.lock = asyncio.Lock()
+
+    async def apply(self, task, args, timeout):
+        task_id = str(uuid.uuid4())
+        key = self.backend.get_key_for_task(task_id)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[key] = future
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            await self._subscribe(key)
+            task.apply_async(args=args, task_id=task_id)
+            result = await asyncio.wait_for(self._wait(key, future), timeout=timeout)
+            outcome = 'ok'
+            return result
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        finally:
+            metrics.CELERY_TASK_DURATION.labels(task.name, outcome).observe(time.perf_counter() - start)
+            self.waiters.pop(key, None)
+            self._cancel_backend_consumer(task_id)
+            await self._unsubscribe(key)
+
+    def _cancel_backend_consumer(self, task_id):
+        # apply_async() also subscribes celery's own result consumer to the task key,
+        # nothing reads that subscription, so drop it before its messages pile up
+        try:
+            self.backend.result_consumer.cancel_for(task_id)
+        except Exception as e:
+            logging.error("ResultWaiter: failed to cancel backend consumer: {}".format(str(e)))
+
+    async def _wait(self, key, future):
+        while True:
+            payload = await self.redis_cli.get(key)
+            if payload is not None:
+                meta = self.backend.decode_result(payload)
+                if meta['status'] == states.SUCCESS:
+                    return meta['result']
+                if meta['status'] in states.PROPAGATE_STATES:
+                    raise meta['result']
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=self.POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            if future.done():
+                future = asyncio.get_running_loop().create_future()
+                self.waiters[key] = future
+
+    async def _subscribe(self, key):
+        async with self.lock:
+            if self.pubsub is None:
+                self.pubsub = self.redis_cli.pubsub()
+            try:
+                await self.pubsub.subscribe(key)
+            except Exception as e:
+                logging.error("ResultWaiter: subscribe failed: {}".format(str(e)))
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self._read())
+
+    async def _unsubscribe(self, key):
+        try:
+            await self.pubsub.unsubscribe(key)
+        except Exception as e:
+            logging.error("ResultWaiter: unsubscribe failed: {}".format(str(e)))
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("ResultWaiter: subscription lost: {}".format(str(e)))
+                await asyncio.sleep(self.POLL_INTERVAL)
+                await self._restore()
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            future = self.waiters.get(message['channel'])
+            if future is not None and not future.done():
+                future.set_result(message['data'])
+
+    async def _restore(self):
+        async with self.lock:
+            old, self.pubsub = self.pubsub, self.redis_cli.pubsub()
+            try:
+                await old.close()
+            except Exception as e:
+                logging.error("ResultWaiter: failed to close subscription: {}".format(str(e)))
+            if self.waiters:
+                try:
+                    await self.pubsub.subscribe(*self.waiters)
+                except Exception as e:
+                    logging.error("ResultWaiter: resubscribe failed: {}".format(str(e)))
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.close()
@@ -7,9 +7,27 @@ from pydantic import BaseSettings
 class Settings(BaseSettings):
     jwt_key: str = 'secret'
     uploads_folder: str = '/tmp/uploads'
+    max_model_size: int = 16 * 1024 * 1024
+    model_prepare_timeout: float = 10
+    prediction_cache_ttl: int = 300
+    max_batch_size: int = 256
+    max_batch_body: int = 1024 * 1024
+    metrics_port: int = 9100
     redis_host: str = '127.0.0.1'
     redis_port: str = 6379
     redis_db: int = 3
+    latest_users_cap: int = 1000
+    users_max_limit: int = 500
+    user_cache_size: int = 4096
+    user_cache_ttl: float = 30
+    session_cache_size: int = 64
+    session_cache_memory: int = 128 * 1024 * 1024
+    session_cache_hash: bool = False
+    predict_batch_size: int = 16
+    predict_batch_wait: float = 0.005
+    predict_mode: str = 'celery'
+    predict_timeout: float = 3
+    predict_local_workers: int = 1
 
     class Config:
         env_file = "config.env"
@@ -10,9 +10,29 @@ def random_key() -> str:
 
 
 # Note: all our API clients depend on this, can't change for legacy reasons.
-def decrypt(data: bytes, key: str) -> bytes:
+def decryptor(key: str):
     if len(key) != KEY_SIZE * 2 + NONCE_SIZE * 2:
         raise ValueError("invalid decryption key")
     cacha_key = b''.fromhex(key[:KEY_SIZE * 2])
-    crypt = ChaCha20.new(key=cacha_key, nonce=b''.fromhex(key[KEY_SIZE * 2:]))
-    return crypt.decrypt(data)
+    return ChaCha20.new(key=cacha_key, nonce=b''.fromhex(key[KEY_SIZE * 2:]))
+
+
+def decrypt(data: bytes, key: str) -> bytes:
+    return decryptor(key).decrypt(data)
+
+
+class TooLargeError(ValueError):
+    pass
+
+
+def decrypt_stream(src, dst, key: str, max_size: int, chunk_size: int = 1 << 20) -> int:
+    crypt = decryptor(key)
+    size = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return size
+        size += len(chunk)
+        if size > max_size:
+            raise TooLargeError("model is too large (max {} bytes)".format(max_size))
+        dst.write(crypt.decrypt(chunk))
@@ -0,0 +1,83 @@
+import os
+import time
+import inspect
+import functools
+
+import prometheus_client
+from prometheus_client import Counter, Histogram, CollectorRegistry, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+# All uvicorn workers (and local prediction processes) write their samples to
+# PROMETHEUS_MULTIPROC_DIR, the directory must be emptied before they start.
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20, 64 << 20)
+
+HTTP_REQUEST_DURATION = Histogram('modelrna_http_request_duration_seconds', 'HTTP request latency by route',
+                                  ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+STORAGE_CALL_DURATION = Histogram('modelrna_storage_call_duration_seconds', 'Redis calls latency by Storage method',
+                                  ['method', 'outcome'], buckets=LATENCY_BUCKETS)
+CELERY_TASK_DURATION = Histogram('modelrna_celery_task_duration_seconds',
+                                 'Time from sending a celery task to getting its result',
+                                 ['task', 'outcome'], buckets=LATENCY_BUCKETS)
+CELERY_TASK_RUN_DURATION = Histogram('modelrna_celery_task_run_duration_seconds',
+                                     'Celery task execution time in the worker',
+                                     ['task', 'state'], buckets=LATENCY_BUCKETS)
+SESSION_CREATE_DURATION = Histogram('modelrna_onnx_session_create_duration_seconds',
+                                    'onnxruntime InferenceSession creation time', buckets=LATENCY_BUCKETS)
+CAPTCHA_CHECKS = Counter('modelrna_captcha_checks_total', 'Captcha challenge and token checks', ['kind', 'result'])
+UPLOAD_SIZE = Histogram('modelrna_model_upload_bytes', 'Uploaded model sizes', buckets=SIZE_BUCKETS)
+
+
+def registry() -> CollectorRegistry:
+    if MULTIPROC_DIR is None:
+        return prometheus_client.REGISTRY
+    reg = CollectorRegistry()
+    multiprocess.MultiProcessCollector(reg)
+    return reg
+
+
+class _Values(object):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+def generate(queue_lengths=None) -> bytes:
+    output = prometheus_client.generate_latest(registry())
+    if queue_lengths is not None:
+        # queue length is a point-in-time value, it is read on scrape
+        gauge = GaugeMetricFamily('modelrna_celery_queue_length', 'Celery broker queue length', labels=['queue'])
+        for queue, length in queue_lengths.items():
+            gauge.add_metric([queue], length)
+        output += prometheus_client.generate_latest(_Values([gauge]))
+    return output
+
+
+def start_http_server(port):
+    prometheus_client.start_http_server(port, registry=registry())
+
+
+def instrument_storage(cls):
+    def wrap(name, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'ok'
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                STORAGE_CALL_DURATION.labels(name, outcome).observe(time.perf_counter() - start)
+        return wrapper
+
+    for name, func in list(vars(cls).items()):
+        if inspect.iscoroutinefunction(func):
+            setattr(cls, name, wrap(name, func))
+    return cls
@@ -1,25 +1,297 @@
+import os
 import time
+import signal
+import asyncio
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import onnxruntime
 
+from app import metrics
+from app.config import get_settings
 
-def predict(model_path: str, scalar):
-    sess = onnxruntime.InferenceSession(model_path)
+OPTIMIZED_SUFFIX = '.opt.onnx'
+WARMUP_ROW = [0, 0, 0, 0, 0.0]
+
+
+class SessionCache(object):
+    def __init__(self, max_entries, max_bytes, hash_models=False):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hash_models = hash_models
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fingerprint(cls, model_path, hash_models=False):
+        st = os.stat(model_path)
+        digest = None
+        if hash_models:
+            with open(model_path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        return st.st_ino, st.st_mtime_ns, st.st_size, digest
+
+    def get(self, model_path):
+        fp = self.fingerprint(model_path, self.hash_models)
+        with self.lock:
+            entry = self.entries.get(model_path)
+            if entry is not None:
+                if entry[0] == fp:
+                    self.entries.move_to_end(model_path)
+                    return entry[1]
+                # model was overwritten by a new upload
+                self._remove(model_path)
+
+        with metrics.SESSION_CREATE_DURATION.time():
+            sess = onnxruntime.InferenceSession(model_path, session_options(model_path.endswith(OPTIMIZED_SUFFIX)))
+        validate_session(sess)
+
+        with self.lock:
+            if model_path in self.entries:
+                self._remove(model_path)
+            size = fp[2]
+            if size <= self.max_bytes and self.max_entries > 0:
+                self.entries[model_path] = (fp, sess)
+                self.total_bytes += size
+                self._evict()
+        return sess
+
+    def invalidate(self, model_path):
+        with self.lock:
+            if model_path in self.entries:
+                self._remove(model_path)
+
+    def _remove(self, model_path):
+        fp, _ = self.entries.pop(model_path)
+        self.total_bytes -= fp[2]
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            model_path, (fp, _) = self.entries.popitem(last=False)
+            self.total_bytes -= fp[2]
+            logging.info("SessionCache: evicted {}".format(model_path))
+
+
+_session_cache = None
+_singletons_lock = threading.Lock()
+
+
+def get_session_cache() -> SessionCache:
+    global _session_cache
+    with _singletons_lock:
+        if _session_cache is None:
+            settings = get_settings()
+            _session_cache = SessionCache(settings.session_cache_size,
+                                          settings.session_cache_memory,
+                                          settings.session_cache_hash)
+    return _session_cache
+
+
+def session_options(optimized=False):
+    options = onnxruntime.SessionOptions()
+    if optimized:
+        # the graph was already optimised when the model was uploaded
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+    return options
+
+
+def model_revision(model_path):
+    st = os.stat(model_path)
+    return '{}-{}'.format(st.st_ino, st.st_mtime_ns)
+
+
+def warm_up(sess):
+    input_name = sess.get_inputs()[0].name
+    output_names = [x.name for x in sess.get_outputs()]
+    sess.run(output_names, {input_name: [WARMUP_ROW]})
+
+
+def prepare_model(model_path: str, optimized_path: str):
+    tmp_path = optimized_path + '.tmp'
+    options = session_options()
+    options.optimized_model_filepath = tmp_path
+    try:
+        try:
+            sess = onnxruntime.InferenceSession(model_path, options)
+            validate_session(sess)
+            warm_up(sess)
+        except ValueError:
+            raise
+        except Exception as e:
+            # onnxruntime load/run errors mean the model itself is broken
+            raise ValueError("failed to run model: {}".format(e)) from e
+        try:
+            sess = onnxruntime.InferenceSession(tmp_path, session_options(optimized=True))
+            validate_session(sess)
+            warm_up(sess)
+        except Exception as e:
+            logging.info("prepare_model(): optimized {} is unusable, keeping the original: {}".format(model_path, e))
+            return None
+        os.replace(tmp_path, optimized_path)
+        return optimized_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def validate_session(sess):
     inputs = sess.get_inputs()
     outputs = sess.get_outputs()
     if len(inputs) != 1:
         raise ValueError("model should have only one input")
     if len(outputs) < 1 or len(outputs) > 2:
         raise ValueError("model should have 1 or 2 outputs (class and probability)")
+
+
+def split_result(outputs, result, index):
+    prediction = result[0].tolist()[index]
+    prediction_prob = None
+    if len(outputs) > 1 and len(result[1]) > index and prediction in result[1][index]:
+        prediction_prob = result[1][index][prediction]
+    return prediction, prediction_prob
+
+
+def run_session(sess, rows):
+    inputs = sess.get_inputs()
+    outputs = sess.get_outputs()
     input_name = inputs[0].name
     output_names = [x.name for x in outputs]
-    result = sess.run(output_names, {input_name: [
+    return outputs, sess.run(output_names, {input_name: rows})
+
+
+def predict_batch(sess, rows):
+    outputs, result = run_session(sess, rows)
+    if len(result[0]) != len(rows):
+        raise ValueError("model output does not match the batch size")
+    return [split_result(outputs, result, i) for i in range(len(rows))]
+
+
+def predict(sess, scalar):
+    outputs, result = run_session(sess, [
         scalar
-    ]
-    })
+    ])
+    return split_result(outputs, result, 0)
 
-    prediction = result[0].tolist()[0]
-    prediction_prob = None
-    if len(outputs) > 1 and len(result[1]) > 0 and prediction in result[1][0]:
-        prediction_prob = result[1][0][prediction]
-    return prediction, prediction_prob
+
+def predict_rows(model_path: str, rows, deadline=None):
+    # returns a (result, error) pair for every row, so a row the model
+    # fails on does not fail the other rows of the batch. Rows that are not
+    # reached before the deadline (a time.time() value) are reported as timed out
+    sess = get_session_cache().get(str(model_path))
+    if len(rows) > 1:
+        try:
+            return [(res, None) for res in predict_batch(sess, rows)]
+        except Exception as e:
+            # not every model handles more than one row, fall back to single rows
+            logging.info("predict_rows(): batch of {} failed for {}: {}".format(len(rows), model_path, e))
+
+    results = []
+    for row in rows:
+        if deadline is not None and time.time() > deadline:
+            results.append((None, 'prediction timed out'))
+            continue
+        try:
+            results.append((predict(sess, row), None))
+        except Exception as e:
+            results.append((None, str(e) or type(e).__name__))
+    return results
+
+
+class _Batch(object):
+    def __init__(self):
+        self.rows = []
+        self.full = asyncio.Event()
+        self.results = asyncio.get_running_loop().create_future()
+
+
+class BatchPredictor(object):
+    # Concurrent predictions for the same model are collected for up to max_wait
+    # seconds (or max_batch_size rows) and sent to a single worker process as one
+    # predict_rows call, which runs them with one sess.run where the model allows it.
+    def __init__(self, run, max_batch_size, max_wait):
+        self.run = run
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = {}
+
+    async def predict(self, model_path, scalar):
+        model_path = str(model_path)
+        batch = self.pending.get(model_path)
+        if batch is None:
+            batch = _Batch()
+            self.pending[model_path] = batch
+            asyncio.create_task(self._flush(model_path, batch))
+        index = len(batch.rows)
+        batch.rows.append(scalar)
+        if len(batch.rows) >= self.max_batch_size:
+            del self.pending[model_path]
+            batch.full.set()
+
+        # the batch keeps running for the other callers if this one is cancelled
+        result, error = (await asyncio.shield(batch.results))[index]
+        if error is not None:
+            raise ValueError(error)
+        return result
+
+    async def _flush(self, model_path, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        if self.pending.get(model_path) is batch:
+            del self.pending[model_path]
+
+        try:
+            batch.results.set_result(await self.run(model_path, batch.rows))
+        except Exception as e:
+            batch.results.set_exception(e)
+            # retrieved here in case every caller has already given up
+            batch.results.exception()
+
+
+class ProcessPredictor(object):
+    def __init__(self, max_workers, timeout):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.max_workers,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def _recycle(self, pool):
+        if pool is not self.pool:
+            return
+        self.pool = self._new_pool()
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False)
+        # let the other in-flight predictions finish, then kill whatever is still stuck
+        asyncio.get_running_loop().call_later(self.timeout, self._kill, processes)
+
+    @classmethod
+    def _kill(cls, processes):
+        for process in processes:
+            if process.is_alive():
+                logging.error("ProcessPredictor: killing worker {}".format(process.pid))
+                os.kill(process.pid, signal.SIGKILL)
+
+    async def call(self, func, *args, timeout=None):
+        pool = self.pool
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(pool, func, *args),
+                                          timeout=timeout or self.timeout)
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            self._recycle(pool)
+            raise
+
+    def close(self):
+        processes = list((self.pool._processes or {}).values())
+        self.pool.shutdown(wait=False)
+        self._kill(processes)
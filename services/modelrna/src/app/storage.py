@@ -5,18 +5,30 @@ from hashlib import sha1
 
 import aioredis
 
+from app import metrics
+from app.config import get_settings
 
+
+@metrics.instrument_storage
 class Storage(object):
     USERS_SET = 'users'
     USER_LOGINS_SET = 'user-logins'
     LATEST_USERS_LIST = 'latest-users'
+    LATEST_USERS_VERSION = 'latest-users-version'
     VACCINE_TEST_IDS_LIST_PREFIX = 'vaccine-test-ids'
     VACCINE_TESTS_SET = 'vaccine-tests'
+    MODEL_STATUS_SET = 'vaccine-model-status'
+    PREDICTIONS_PREFIX = 'predictions'
     CAPTCHA_CHALLENGES_PREFIX = 'captcha-challenges'
     CAPTCHA_TOKENS_PREFIX = 'captcha-tokens'
 
+    # per-process cache of the serialised latest users list, see latest_users()
+    _latest_users_cache = {'version': None, 'records': [], 'blobs': {}}
+    LATEST_USERS_BLOBS = 4
+
     def __init__(self, redis_cli: aioredis.Redis):
         self.redis_cli = redis_cli
+        self.settings = get_settings()
 
     @classmethod
     def uuid(cls):
@@ -81,6 +93,8 @@ class Storage(object):
                 # Finish the TX.
                 await tx.incr(lock_string)
                 await tx.rpush(self.LATEST_USERS_LIST, public_info)
+                await tx.ltrim(self.LATEST_USERS_LIST, -self.settings.latest_users_cap, -1)
+                await tx.incr(self.LATEST_USERS_VERSION)
                 await tx.execute()
 
         except aioredis.WatchError as e:
@@ -91,26 +105,53 @@ class Storage(object):
             raise e
         return uid
 
-    async def latest_users(self, limit=500):
+    async def latest_users(self, limit=500) -> bytes:
+        # only the newest latest_users_cap users are kept in the list and at most
+        # users_max_limit of them are returned, older users are not listed anymore
         try:
-            users = await self.redis_cli.lrange(self.LATEST_USERS_LIST, -limit - 1, -1)
-            out = []
-            for rec in users:
-                out.append(json.loads(rec.decode()))
-            return out[::-1]
+            cache = self._latest_users_cache
+            version = await self.redis_cli.get(self.LATEST_USERS_VERSION)
+            if version is None or version != cache['version']:
+                users = await self.redis_cli.lrange(self.LATEST_USERS_LIST, -self.settings.users_max_limit, -1)
+                cache['version'], cache['records'], cache['blobs'] = version, users[::-1], {}
+            limit = max(0, min(limit, self.settings.users_max_limit))
+            blob = cache['blobs'].get(limit)
+            if blob is None:
+                # records are stored as serialised json already, no need to decode them
+                blob = b'[' + b','.join(cache['records'][:limit]) + b']'
+                # only a few limits are kept, clients may ask for any of them
+                if len(cache['blobs']) >= self.LATEST_USERS_BLOBS:
+                    cache['blobs'].pop(next(iter(cache['blobs'])))
+                cache['blobs'][limit] = blob
+            return blob
         except Exception as e:
             logging.error("Storage.latest_users(): {}".format(str(e)))
-            return []
+            return b'[]'
 
     # # # Test functions # # #
     async def save_vaccine_test(self, vaccine_id, test_id, test_data):
         try:
-            await self.redis_cli.hset(self.VACCINE_TESTS_SET, test_id, json.dumps(test_data))
-            await self.redis_cli.lpush(self.VACCINE_TEST_IDS_LIST_PREFIX + ":" + vaccine_id, test_id)
+            ids_key = self.VACCINE_TEST_IDS_LIST_PREFIX + ":" + vaccine_id
+            async with self.redis_cli.pipeline(transaction=False) as pipe:
+                await pipe.hset(self.VACCINE_TESTS_SET, test_id, json.dumps(test_data))
+                await pipe.lpush(ids_key, test_id)
+                await pipe.execute()
         except Exception as e:
             logging.error("Storage.save_vaccine_test(): {}".format(str(e)))
             raise e
 
+    async def save_vaccine_tests(self, vaccine_id, tests):
+        try:
+            ids_key = self.VACCINE_TEST_IDS_LIST_PREFIX + ":" + vaccine_id
+            async with self.redis_cli.pipeline(transaction=False) as pipe:
+                await pipe.hset(self.VACCINE_TESTS_SET,
+                                mapping={test_id: json.dumps(test_data) for test_id, test_data in tests})
+                await pipe.lpush(ids_key, *[test_id for test_id, _ in tests])
+                await pipe.execute()
+        except Exception as e:
+            logging.error("Storage.save_vaccine_tests(): {}".format(str(e)))
+            raise e
+
     async def get_vaccine_test(self, test_id):
         try:
             return json.loads(await self.redis_cli.hget(self.VACCINE_TESTS_SET, test_id))
@@ -118,13 +159,28 @@ class Storage(object):
             logging.error("Storage.get_vaccine_test(): {}".format(str(e)))
             raise e
 
-    async def get_tests_for_vaccine(self, vaccine_id):
+    async def get_tests_for_vaccine(self, vaccine_id, offset=0, limit=None):
         try:
-            keys = await self.redis_cli.lrange(self.VACCINE_TEST_IDS_LIST_PREFIX + ":" + vaccine_id, 0, -1)
+            end = -1 if limit is None else offset + limit - 1
+            keys = await self.redis_cli.lrange(self.VACCINE_TEST_IDS_LIST_PREFIX + ":" + vaccine_id, offset, end)
+            if not keys:
+                return []
+            values = await self.redis_cli.hmget(self.VACCINE_TESTS_SET, keys)
+            found = []
+            for key, value in zip(keys, values):
+                if value is None:
+                    logging.error('failed to get test_data by id "{}": not found'.format(key))
+                else:
+                    found.append((key, value))
+            try:
+                return json.loads(b'[' + b','.join(value for _, value in found) + b']')
+            except Exception:
+                pass
+            # some record is corrupted, decode one by one to skip it
             results = []
-            for key in keys:
+            for key, value in found:
                 try:
-                    results.append(await self.get_vaccine_test(key))
+                    results.append(json.loads(value))
                 except Exception as e:
                     logging.error('failed to get test_data by id "{}": {}'.format(key, str(e)))
             return results
@@ -132,45 +188,71 @@ class Storage(object):
             logging.error("Storage.get_tests_for_vaccine(): {}".format(str(e)))
             raise e
 
-    # # # Captcha functions # # #
-    async def store_challenge(self, chal_id, value, ttl=60):
+    # # # Model functions # # #
+    async def set_model_status(self, vaccine_id, status):
         try:
-            await self.redis_cli.set(self.CAPTCHA_CHALLENGES_PREFIX + ':' + chal_id, value, ex=ttl)
+            await self.redis_cli.hset(self.MODEL_STATUS_SET, vaccine_id, json.dumps(status))
         except Exception as e:
-            logging.error("failed to create captcha key: {}".format(str(e)))
+            logging.error("Storage.set_model_status(): {}".format(str(e)))
             raise e
 
-    async def get_challenge(self, chal_id) -> bytes:
+    async def get_model_status(self, vaccine_id):
         try:
-            return await self.redis_cli.get(self.CAPTCHA_CHALLENGES_PREFIX + ":" + chal_id)
+            status = await self.redis_cli.hget(self.MODEL_STATUS_SET, vaccine_id)
+            return json.loads(status) if status else None
         except Exception as e:
-            logging.error("failed to get captcha key: {}".format(str(e)))
+            logging.error("Storage.get_model_status(): {}".format(str(e)))
             raise e
 
-    async def revoke_challenge(self, chal_id):
+    @classmethod
+    def prediction_key(cls, vaccine_id, revision, features):
+        return cls.PREDICTIONS_PREFIX + ':' + vaccine_id + ':' + revision + ':' + json.dumps(features)
+
+    async def get_cached_prediction(self, vaccine_id, revision, features):
+        try:
+            res = await self.redis_cli.get(self.prediction_key(vaccine_id, revision, features))
+            return json.loads(res) if res else None
+        except Exception as e:
+            logging.error("Storage.get_cached_prediction(): {}".format(str(e)))
+            return None
+
+    async def cache_prediction(self, vaccine_id, revision, features, res, ttl):
+        if ttl <= 0:
+            return
+        try:
+            await self.redis_cli.set(self.prediction_key(vaccine_id, revision, features), json.dumps(res), ex=ttl)
+        except Exception as e:
+            logging.error("Storage.cache_prediction(): {}".format(str(e)))
+
+    # # # Captcha functions # # #
+    async def store_challenge(self, chal_id, value, ttl=60):
         try:
-            await self.redis_cli.delete(self.CAPTCHA_CHALLENGES_PREFIX + ":" + chal_id)
+            await self.redis_cli.set(self.CAPTCHA_CHALLENGES_PREFIX + ':' + chal_id, value, ex=ttl)
         except Exception as e:
-            logging.error("failed to delete captcha key: {}".format(str(e)))
+            logging.error("failed to create captcha key: {}".format(str(e)))
             raise e
 
-    async def create_captcha_token(self, key, ttl=30):
+    async def pop_challenge(self, chal_id) -> bytes:
         try:
-            await self.redis_cli.set(self.CAPTCHA_TOKENS_PREFIX + ":" + key, '1', ex=ttl)
+            async with self.redis_cli.pipeline(transaction=True) as tx:
+                await tx.get(self.CAPTCHA_CHALLENGES_PREFIX + ":" + chal_id)
+                await tx.delete(self.CAPTCHA_CHALLENGES_PREFIX + ":" + chal_id)
+                challenge, _ = await tx.execute()
+            return challenge
         except Exception as e:
-            logging.error("failed to create captcha token: {}".format(str(e)))
+            logging.error("failed to pop captcha key: {}".format(str(e)))
             raise e
 
-    async def check_captcha_token(self, key):
+    async def create_captcha_token(self, key, ttl=30):
         try:
-            return await self.redis_cli.exists(self.CAPTCHA_TOKENS_PREFIX + ":" + key)
+            await self.redis_cli.set(self.CAPTCHA_TOKENS_PREFIX + ":" + key, '1', ex=ttl)
         except Exception as e:
             logging.error("failed to create captcha token: {}".format(str(e)))
             raise e
 
-    async def remove_captcha_token(self, key):
+    async def pop_captcha_token(self, key) -> bool:
         try:
-            await self.redis_cli.delete(self.CAPTCHA_TOKENS_PREFIX + ":" + key)
+            return await self.redis_cli.delete(self.CAPTCHA_TOKENS_PREFIX + ":" + key) > 0
         except Exception as e:
-            logging.error("failed to delete captcha token: {}".format(str(e)))
+            logging.error("failed to pop captcha token: {}".format(str(e)))
             raise e
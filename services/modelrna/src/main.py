@@ -1,20 +1,78 @@
 import functools
+import contextlib
+import json
+import os
+import re
 import sys
+import time
 import uuid
+import typing
 import pathlib
 import logging
+import tempfile
 
 import aioredis
 import uvicorn
 import fastapi
 
 from functools import lru_cache
-from starlette import concurrency
+from fastapi import responses
+from starlette import concurrency, routing, formparsers, datastructures
 
-from app import config, session, dto, storage, captcha, utils, crypto, ml, celery_app
+from app import config, session, dto, storage, captcha, utils, crypto, ml, celery_app, celery_results, batch, metrics
 
 app = fastapi.FastAPI()
 
+MULTIPART_OVERHEAD = 64 * 1024
+PREDICT_DEADLINE_MARGIN = 0.5
+
+
+def route_name(scope) -> str:
+    for route in scope['app'].routes:
+        match, _ = route.matches(scope)
+        if match == routing.Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware(object):
+    # plain ASGI middleware: BaseHTTPMiddleware would hold the response
+    # until the background tasks of the request are finished
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        observed = False
+
+        def observe():
+            nonlocal observed
+            if not observed:
+                observed = True
+                metrics.HTTP_REQUEST_DURATION.labels(scope['method'], route_name(scope), status).observe(
+                    time.perf_counter() - start)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                observe()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            observe()
+
+
+app.add_middleware(MetricsMiddleware)
+
 
 @lru_cache()
 def get_session_handler() -> session.JWTSession:
@@ -36,34 +94,70 @@ async def get_captcha_helper(storage: storage.Storage = fastapi.Depends(get_stor
 
 
 @celery_app.celery_app.task()
-def ml_predict_async(model_path, data):
-    return ml.predict(model_path, data)
+def ml_predict_rows_async(model_path, rows, deadline=None):
+    return ml.predict_rows(model_path, rows, deadline)
+
+
+@celery_app.celery_app.task()
+def ml_prepare_async(model_path, optimized_path):
+    return ml.prepare_model(model_path, optimized_path)
 
 
 def json_error(error):
     return {'error': error}
 
 
+@lru_cache()
+def get_user_cache() -> utils.TTLCache:
+    settings = config.get_settings()
+    return utils.TTLCache(settings.user_cache_size, settings.user_cache_ttl)
+
+
 async def get_current_user(request: fastapi.Request) -> str:
-    try:
-        api_token = request.cookies.get('Api-Token') or request.headers.get('X-Api-Token')
-        if api_token is None:
-            raise ValueError("Empty Api-Token/cookie")
-        session_h = get_session_handler()
-        user_data = session_h.decode_token(api_token.encode())
-    except Exception as e:
+    api_token = request.cookies.get('Api-Token') or request.headers.get('X-Api-Token')
+    if api_token is None:
         raise fastapi.HTTPException(
             status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
             detail="could not validate credentials",
         )
-    user_id = user_data.get('user_id')
-    request.state.storage = storage.Storage(request.app.state.redis_pool)
-    if not await request.state.storage.user_exists(user_id):
-        raise fastapi.HTTPException(
-            status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
-            detail="user not found"
-        )
-    return user_id
+
+    # tokens are verified once and mapped to the user record for a short time
+    user_cache = get_user_cache()
+    user = user_cache.get(api_token)
+    if user is None:
+        user_data = get_session_handler().decode_token(api_token.encode())
+        if not isinstance(user_data, dict):
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
+                detail="could not validate credentials",
+            )
+        user_id = user_data.get('user_id')
+        request.state.storage = storage.Storage(request.app.state.redis_pool)
+        user = await request.state.storage.find_user(user_id) if user_id else None
+        if not isinstance(user, dict):
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
+                detail="user not found"
+            )
+        user_cache.put(api_token, user)
+    request.state.user = user
+    return user['user_id']
+
+
+async def get_current_user_info(request: fastapi.Request,
+                                user_id: str = fastapi.Depends(get_current_user)) -> dict:
+    return request.state.user
+
+
+@app.get('/metrics')
+async def metrics_handle(request: fastapi.Request):
+    queue_lengths = None
+    try:
+        queue = celery_app.celery_app.conf.task_default_queue
+        queue_lengths = {queue: await request.app.state.results.redis_cli.llen(queue)}
+    except Exception as e:
+        logging.error("failed to get celery queue length: {}".format(str(e)))
+    return fastapi.Response(content=metrics.generate(queue_lengths), media_type=metrics.CONTENT_TYPE)
 
 
 @app.get("/")
@@ -123,48 +217,163 @@ async def login_handle(response: fastapi.Response, auth_req: dto.AuthRequest,
 async def latest_users_list(request: fastapi.Request):
     st = storage.Storage(request.app.state.redis_pool)
     user_infos = await st.latest_users(int(request.query_params.get('limit', '200')))
-    return user_infos
+    return fastapi.Response(content=user_infos, media_type='application/json')
 
 
 @app.get('/api/userinfo')
-async def get_user_info(st: storage.Storage = fastapi.Depends(get_storage),
-                        user_id: str = fastapi.Depends(get_current_user)):
-    info = await st.find_user(user_id)
+async def get_user_info(info: dict = fastapi.Depends(get_current_user_info)):
     info = {k: v for k, v in info.items() if k != 'password'}
     return info
 
 
+async def read_limited(request: fastapi.Request, max_size: int):
+    content_length = request.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > max_size:
+        raise crypto.TooLargeError("request is too large (max {} bytes)".format(max_size))
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_size:
+            raise crypto.TooLargeError("request is too large (max {} bytes)".format(max_size))
+        yield chunk
+
+
+async def read_model_upload(request: fastapi.Request, max_size: int) -> fastapi.UploadFile:
+    # the body is parsed here instead of declaring a File() parameter, otherwise
+    # starlette would spool the whole upload to disk before any limit is checked
+    if not request.headers.get('Content-Type', '').startswith('multipart/form-data'):
+        raise ValueError("multipart/form-data body expected")
+    # leave some room for the multipart boundaries and part headers
+    parser = formparsers.MultiPartParser(request.headers, read_limited(request, max_size + MULTIPART_OVERHEAD))
+    form = await parser.parse()
+    file = form.get('file')
+    if not isinstance(file, datastructures.UploadFile):
+        await form.close()
+        raise ValueError("no model file provided")
+    return file
+
+
+def store_model(src, model_path: pathlib.Path, key: str, max_size: int):
+    # decrypt into a temporary file next to the model and swap it in atomically,
+    # so the prediction workers never see a partially written model
+    fd, tmp_path = tempfile.mkstemp(dir=model_path.parent, prefix=model_path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            size = crypto.decrypt_stream(src, dst, key, max_size)
+        metrics.UPLOAD_SIZE.observe(size)
+        revision = ml.model_revision(tmp_path)
+        os.replace(tmp_path, model_path)
+        return revision
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+async def prepare_model(app_state, st: storage.Storage, vaccine_id: str, model_path: pathlib.Path, revision: str):
+    # validate and optimise the uploaded model in background, so broken models
+    # are rejected on prediction instead of running into the timeout every time
+    settings = config.get_settings()
+    optimized_path = str(model_path.with_name(f'{vaccine_id}.{revision}{ml.OPTIMIZED_SUFFIX}'))
+    try:
+        if settings.predict_mode == 'local':
+            optimized_path = await app_state.predictor.call(ml.prepare_model, str(model_path), optimized_path,
+                                                            timeout=settings.model_prepare_timeout)
+        else:
+            optimized_path = await app_state.results.apply(ml_prepare_async, (str(model_path), optimized_path),
+                                                           timeout=settings.model_prepare_timeout)
+        status = {'status': 'ready', 'revision': revision, 'optimized_path': optimized_path}
+    except ValueError as e:
+        logging.error("model {} is invalid: {}".format(model_path, str(e)))
+        status = {'status': 'invalid', 'revision': revision, 'error': str(e)}
+    except Exception as e:
+        # timeouts and broker errors say nothing about the model itself,
+        # leave it pending so predictions keep using the original model
+        logging.error("failed to prepare model {}: {}".format(model_path, repr(e)))
+        return
+
+    try:
+        current = await st.get_model_status(vaccine_id)
+        if current and current.get('revision') != revision:
+            # the model was uploaded again while we were busy
+            remove_optimized_model(status)
+            return
+        await st.set_model_status(vaccine_id, status)
+    except Exception as e:
+        logging.error("failed to update model status: {}".format(str(e)))
+
+
+def remove_optimized_model(status):
+    if status and status.get('optimized_path'):
+        with contextlib.suppress(OSError):
+            os.unlink(status['optimized_path'])
+
+
 @app.post('/api/vaccine/upload')
-async def upload_vaccine_model(st: storage.Storage = fastapi.Depends(get_storage),
-                               user_id: str = fastapi.Depends(get_current_user),
-                               file: fastapi.UploadFile = fastapi.File(...)):
+async def upload_vaccine_model(request: fastapi.Request,
+                               background_tasks: fastapi.BackgroundTasks,
+                               info: dict = fastapi.Depends(get_current_user_info),
+                               st: storage.Storage = fastapi.Depends(get_storage)):
     settings = config.get_settings()
-    info = await st.find_user(user_id)
+    try:
+        file = await read_model_upload(request, settings.max_model_size)
+    except crypto.TooLargeError as e:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=json_error("failed to upload model: {}".format(str(e)))
+        )
+    except ValueError as e:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=json_error("failed to upload model: {}".format(str(e)))
+        )
+
     try:
         v_info = info['vaccine_info']
-        file_readed = await file.read()
-        decrypted_model = await concurrency.run_in_threadpool(crypto.decrypt, file_readed,
-                                                              v_info['vaccine_key'])
         v_id = v_info['vaccine_id']
         model_path = pathlib.Path(settings.uploads_folder) / f'{v_id}.onnx'
-        with open(model_path, 'wb') as f:
-            await concurrency.run_in_threadpool(f.write, decrypted_model)
-
+        revision = await concurrency.run_in_threadpool(store_model, file.file, model_path, v_info['vaccine_key'],
+                                                       settings.max_model_size)
+        previous = await st.get_model_status(v_id)
+        await st.set_model_status(v_id, {'status': 'pending', 'revision': revision})
+        remove_optimized_model(previous)
+        background_tasks.add_task(prepare_model, request.app.state, st, v_id, model_path, revision)
+    except crypto.TooLargeError as e:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=json_error("failed to upload model: {}".format(str(e)))
+        )
     except Exception as e:
         raise fastapi.HTTPException(
             status_code=fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=json_error("failed to upload model: {}".format(str(e)))
         )
+    finally:
+        await file.close()
     return {}
 
 
-@app.post('/api/vaccine/{vaccine_id}/test')
-async def predict_handle(cr: dto.CheckRequest,
-                         request: fastapi.Request,
-                         vaccine_id: str = fastapi.Path(..., regex=utils.uuid_regexp),
-                         st: storage.Storage = fastapi.Depends(get_storage),
-                         ch: captcha.CaptchaHelper = fastapi.Depends(get_captcha_helper)):
-    settings = config.get_settings()
+async def verify_captcha(request: fastapi.Request, ch: captcha.CaptchaHelper):
+    # the challenge can be solved together with the request itself
+    # instead of exchanging it for a token via /api/captcha/validate
+    captcha_key = request.headers.get('X-Captcha-Key', '')
+    if captcha_key:
+        captcha_answer = request.headers.get('X-Captcha-Answer', '')
+        try:
+            if not re.fullmatch(utils.uuid_regexp, captcha_key):
+                raise KeyError("invalid captcha key")
+            is_ok = await ch.check(captcha_key, captcha_answer)
+        except KeyError as e:
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_412_PRECONDITION_FAILED,
+                detail=str(e)
+            )
+        if not is_ok:
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_412_PRECONDITION_FAILED,
+                detail='invalid key'
+            )
+        return
+
     captcha_token = request.headers.get('X-Captcha-Token', '')
     if not captcha_token:
         raise fastapi.HTTPException(
@@ -178,6 +387,19 @@ async def predict_handle(cr: dto.CheckRequest,
             detail=json_error("invalid captcha token provided")
         )
 
+
+async def predict_rows(app_state, model_path: str, rows):
+    settings = config.get_settings()
+    # the single-row fallback stops early enough to return the rows it has done
+    deadline = time.time() + settings.predict_timeout - PREDICT_DEADLINE_MARGIN
+    if settings.predict_mode == 'local':
+        return await app_state.predictor.call(ml.predict_rows, model_path, rows, deadline)
+    return await app_state.results.apply(ml_predict_rows_async, (model_path, rows, deadline),
+                                         timeout=settings.predict_timeout)
+
+
+async def resolve_model(st: storage.Storage, vaccine_id: str):
+    settings = config.get_settings()
     path = pathlib.Path(settings.uploads_folder) / f'{vaccine_id}.onnx'
     if not path.exists():
         raise fastapi.HTTPException(
@@ -185,15 +407,43 @@ async def predict_handle(cr: dto.CheckRequest,
             detail=json_error("Vaccine model is not loaded yet")
         )
 
-    try:
-        task = ml_predict_async.delay(str(path), cr.to_scalar())
-        res = await concurrency.run_in_threadpool(functools.partial(task.get, timeout=3), timeout=3)
-    except Exception as e:
-        logging.error("model prediction failed: " + str(e))
-        raise fastapi.HTTPException(
-            status_code=fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=json_error("model is invalid or running too long")
-        )
+    model_path = str(path)
+    revision = ml.model_revision(path)
+    status = await st.get_model_status(vaccine_id)
+    if status and status.get('revision') == revision:
+        if status['status'] == 'invalid':
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_400_BAD_REQUEST,
+                detail=json_error("model is invalid: {}".format(status.get('error')))
+            )
+        if status.get('optimized_path') and os.path.exists(status['optimized_path']):
+            model_path = status['optimized_path']
+    return model_path, revision
+
+
+@app.post('/api/vaccine/{vaccine_id}/test')
+async def predict_handle(cr: dto.CheckRequest,
+                         request: fastapi.Request,
+                         vaccine_id: str = fastapi.Path(..., regex=utils.uuid_regexp),
+                         st: storage.Storage = fastapi.Depends(get_storage),
+                         ch: captcha.CaptchaHelper = fastapi.Depends(get_captcha_helper)):
+    settings = config.get_settings()
+    await verify_captcha(request, ch)
+    model_path, revision = await resolve_model(st, vaccine_id)
+
+    # only the model output is cached, the test itself is stored for every request
+    features = cr.to_scalar()
+    res = await st.get_cached_prediction(vaccine_id, revision, features)
+    if res is None:
+        try:
+            res = await request.app.state.batch_predictor.predict(model_path, features)
+        except Exception as e:
+            logging.error("model prediction failed: " + str(e))
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=json_error("model is invalid or running too long")
+            )
+        await st.cache_prediction(vaccine_id, revision, features, res, settings.prediction_cache_ttl)
 
     test_data = cr.dict()
 
@@ -205,6 +455,62 @@ async def predict_handle(cr: dto.CheckRequest,
     return {'test_id': test_id, 'prediction': res[0], 'prediction_probability': res[1]}
 
 
+@app.post('/api/vaccine/{vaccine_id}/test/batch')
+async def predict_batch_handle(request: fastapi.Request,
+                               vaccine_id: str = fastapi.Path(..., regex=utils.uuid_regexp),
+                               st: storage.Storage = fastapi.Depends(get_storage),
+                               ch: captcha.CaptchaHelper = fastapi.Depends(get_captcha_helper)):
+    settings = config.get_settings()
+    await verify_captcha(request, ch)
+    model_path, revision = await resolve_model(st, vaccine_id)
+
+    try:
+        rows = await batch.read_rows(request.headers.get('Content-Type', ''), request.stream(),
+                                     settings.max_batch_size, settings.max_batch_body)
+    except batch.BatchTooLargeError as e:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=json_error(str(e))
+        )
+    except ValueError as e:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=json_error(str(e))
+        )
+
+    features = [cr.to_scalar() for cr in rows]
+    try:
+        results = await predict_rows(request.app.state, model_path, features)
+    except Exception as e:
+        logging.error("model batch prediction failed: " + str(e))
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=json_error("model is invalid or running too long")
+        )
+
+    tests = []
+    lines = []
+    for cr, (res, error) in zip(rows, results):
+        if error is not None:
+            # only the failed row is reported, the others are still stored
+            lines.append({'error': error})
+            continue
+        test_data = cr.dict()
+        test_data['prediction'] = res[0]
+        test_data['prediction_probability'] = res[1]
+        test_id = str(uuid.uuid4())
+        tests.append((test_id, test_data))
+        lines.append({'test_id': test_id, 'prediction': res[0], 'prediction_probability': res[1]})
+    if tests:
+        await st.save_vaccine_tests(vaccine_id, tests)
+
+    def stream_results():
+        for line in lines:
+            yield json.dumps(line) + '\n'
+
+    return responses.StreamingResponse(stream_results(), media_type='application/x-ndjson')
+
+
 @app.get('/api/vaccine/test/{test_id}')
 async def get_test_info(test_id: str = fastapi.Path(..., regex=utils.uuid_regexp),
                         st: storage.Storage = fastapi.Depends(get_storage)):
@@ -212,12 +518,13 @@ async def get_test_info(test_id: str = fastapi.Path(..., regex=utils.uuid_regexp
 
 
 @app.get('/api/vaccine/tests')
-async def get_vaccine_tests(user_id: str = fastapi.Depends(get_current_user),
-                            st: storage.Storage = fastapi.Depends(get_storage)):
-    info = await st.find_user(user_id)
+async def get_vaccine_tests(info: dict = fastapi.Depends(get_current_user_info),
+                            st: storage.Storage = fastapi.Depends(get_storage),
+                            offset: int = fastapi.Query(0, ge=0),
+                            limit: typing.Optional[int] = fastapi.Query(None, ge=1)):
     v_info = info.get('vaccine_info')
     v_id = v_info.get('vaccine_id')
-    return await st.get_tests_for_vaccine(v_id)
+    return await st.get_tests_for_vaccine(v_id, offset, limit)
 
 
 @app.get('/api/captcha/get')
@@ -246,7 +553,21 @@ async def validate_captcha(req: dto.CaptchaValidateRequest,
 
 @app.on_event("startup")
 def startup():
+    settings = config.get_settings()
     app.state.redis_pool = redis_pool()
+    app.state.results = celery_results.ResultWaiter(aioredis.from_url(settings.redis_celery_url),
+                                                    celery_app.celery_app.backend)
+    if settings.predict_mode == 'local':
+        app.state.predictor = ml.ProcessPredictor(settings.predict_local_workers, settings.predict_timeout)
+    app.state.batch_predictor = ml.BatchPredictor(functools.partial(predict_rows, app.state),
+                                                  settings.predict_batch_size, settings.predict_batch_wait)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.results.close()
+    if getattr(app.state, 'predictor', None) is not None:
+        app.state.predictor.close()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import hashlib
 import sys
 
 import checklib
@@ -9,6 +8,8 @@ import onnx
 import jwt
 from Cryptodome.Cipher import ChaCha20
 
+import pow_solver
+
 
 IP = sys.argv[1]
 PORT = 8000
@@ -81,12 +82,7 @@ class ApiHelper:
         return self._send_prediction(vaccine_id, data, resp['captcha_token'])
 
     def mine(self, message, size):
-        for x in range(10 ** 100):
-            s = message + str(x)
-            s = s.encode()
-            hsh = hashlib.sha256(s).hexdigest()
-            if hsh.startswith('0' * size):
-                return x
+        return pow_solver.solve(message, size)
 
 
 def build_sploit_model(out_path, path="../../../../app/config.env", bytes_to_leak=5):